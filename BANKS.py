@@ -4,484 +4,618 @@ import pandas as pd
 import os
 import numpy as np
 import re
+import io
+import hashlib
+import shutil
+import uuid
+import transactions
+import utils
+from transactions import format_transactions, transaction_frame
+from utils import (AUDIT_DIR, OUTPUT_DATE_FORMAT, OUTPUT_FORMATS, ZIP_MIME, audit_lines, auditing, cache_result,
+                   clear_result_cache, convert_concurrently, download, excel_sheet_names, get_cached_result,
+                   job_progress, open_chunk_writers, record_stages, result_cache_key, result_cache_size,
+                   save_output_copy, select_output_formats, show_conversion, show_jobs, source_version, stage,
+                   stage_source, stages_enabled, start_job, to_format_bytes, to_format_sheets, to_zip_bytes,
+                   write_audit_lines, write_chunks)
 
 
 # Ensure the 'temp' directory exists
 if not os.path.exists("temp"):
     os.makedirs("temp")
 
-# Initialize the file list and master file variable
+# Initialize the file list
 file_list = []  # Will store text files
-df_masterfile = None  # Will hold the master Excel file data
 
-
-
-def process_standard_bank_files(file_list, df_masterfile):
-    for file in file_list:
-        try:
-            # Read the text file with all 8 columns
-            df = pd.read_csv(file, header=None)
-
-            # Drop unnecessary columns (0, 2, 4, 6, 7)
-            df.drop(columns=[0, 2, 4, 6, 7], inplace=True)
-
-            # Rename remaining columns to 'DATE', 'AMOUNT', 'DESCRIPTION'
-            df.columns = ['DATE', 'AMOUNT', 'DESCRIPTION']
-            df['DESCRIPTION'] = df['DESCRIPTION'].str.strip()  # Remove leading/trailing spaces
-
-            # Add an auxiliary column for the original index
-            df['original_index'] = df.index
-
-            #remove faulty first 7 chars
-            df['First_Seven_Chars'] = df['DESCRIPTION'].str[:6]
-
-            # Remove the first 6 characters from the original column
-            df['DESCRIPTION'] = df['DESCRIPTION'].str[6:]
-
-            def get_matching_code(line):
-                line = str(line).strip()  # Ensure it's a string and remove any surrounding spaces
-
-                # Pattern 13: 'DIV' followed by one or two numbers (anywhere in line, but not part of another word)
-                match13 = re.search(r'\bDIV(\d{1,2})\b', line)
-                if match13:
-                    code = match13.group(1)  # Extract only the number part
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern13'
-
-                # Pattern 6: 2 numbers, 3 letters, 4 numbers (start of line)
-                match6 = re.search(r'^\d{2}[A-Z]{3}\d{4}\b', line)
-                if match6:
-                    code = match6.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern6'
-
-                # Pattern 2: 2 numbers, 4 letters, 3 numbers (start of line)
-                match2 = re.search(r'^\d{2}[A-Z]{4}\d{3}\b', line)
-                if match2:
-                    code = match2.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern2'
-
-                # Pattern 1: 2 numbers, 3 letters, 3 numbers (start of line)
-                match1 = re.search(r'^\d{2}[A-Z]{3}\d{3}\b', line)
-                if match1:
-                    code = match1.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern1'
-
-                # Pattern 7: 3 letters, 4 numbers (start of line)
-                match7 = re.search(r'^[A-Z]{3}\d{4}\b', line)
-                if match7:
-                    code = match7.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern7'
-
-                # Pattern 8: 3 letters, 3 numbers (start of line)
-                match8 = re.search(r'^[A-Z]{3}\d{3}\b', line)
-                if match8:
-                    code = match8.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern8'
-
-                # Pattern 3: 1 number, 2 letters, 3 numbers (start of line)
-                match3 = re.search(r'^\d[A-Z]{2}\d{3}\b', line)
-                if match3:
-                    code = match3.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern3'
-
-                # Pattern 4: 1 number, 3 letters, 3 numbers (start of line)
-                match4 = re.search(r'^\d[A-Z]{3}\d{3}\b', line)
-                if match4:
-                    code = match4.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern4'
-
-                # Pattern 5: 2 letters, 4 numbers (start of line)
-                match5 = re.search(r'^[A-Z]{2}\d{4}\b', line)
-                if match5:
-                    code = match5.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern5'
-
-                # Pattern 9: 1 number, 4 letters, 2 numbers (start of line)
-                match9 = re.search(r'^\d[A-Z]{4}\d{2}\b', line)
-                if match9:
-                    code = match9.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern9'
-
-                # Pattern 10: 1 number, 4 letters (start of line)
-                match10 = re.search(r'^\d[A-Z]{4}\b', line)
-                if match10:
-                    code = match10.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern10'
-
-                # Pattern 11: 4 letters, 2 numbers (start of line)
-                match11 = re.search(r'^[A-Z]{4}\d{2}\b', line)
-                if match11:
-                    code = match11.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern11'
-
-                # Pattern 14: 4 letters, 4 numbers (start of line)
-                match14 = re.search(r'^\d[A-Z]{4}\d{4}\b', line)
-                if match14:
-                    code = match14.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern14'
-
-                # Pattern 12: 3 letters, 3 numbers (start of line)
-                match12 = re.search(r'^[A-Z]{3}\d{3}\b', line)
-                if match12:
-                    code = match12.group(0)
-                    if code + ':' in line:  # Check if code is followed by ':'
-                        return None, None
-                    return code, 'pattern12'
-
-                return None, None
-
-            # Apply regex and extract matching codes
-            df['CODE'], df['PATTERN'] = zip(*df['DESCRIPTION'].apply(get_matching_code))
-
-            #ADD back extracted letters
-            df['DESCRIPTION'] = df['First_Seven_Chars'] + df['DESCRIPTION']
-
-            # Split rows based on whether a code was matched
-            df_with_codes = df[df['CODE'].notnull()].copy()
-            df_without_codes = df[df['CODE'].isnull()].copy()
-
-            # Process columns for df_with_codes
-            df_with_codes = pd.merge(
-                df_with_codes,
-                df_masterfile[['CODE1', 'DESCRIPTION']],
-                left_on='CODE',
-                right_on='CODE1',
-                how='left'
-            )
-
-            # Access the correct 'DESCRIPTION_x' column from df_with_codes
-            df_with_codes['DESCRIPTION_CODE'] = df_with_codes['DESCRIPTION_y'].fillna('') + ' ' + df_with_codes[
-                'CODE'].fillna('')
-            df_with_codes.drop(columns=['DESCRIPTION_x', 'DESCRIPTION_y'], inplace=True)
-
-            # Handle rows without codes
-            df_without_codes['DESCRIPTION_CODE'] = df_without_codes['DESCRIPTION'].fillna('')
-            df_without_codes['CODE1'] = None
-
-            # Ensure numeric amount
-            df_with_codes['AMOUNT'] = pd.to_numeric(df_with_codes['AMOUNT'], errors='coerce').fillna(0)
-            df_without_codes['AMOUNT'] = pd.to_numeric(df_without_codes['AMOUNT'], errors='coerce').fillna(0)
-
-            # Date formatting function
-            def format_date(date):
+# Uploaded statements are saved here while they are converted, in a folder per job
+UPLOAD_DIR = os.path.join("temp", "uploads")
+
+# Number of parsed master files kept in memory, the least recently used one is dropped first
+MASTER_CACHE_ENTRIES = 4
+
+# Rows converted at a time in streaming mode
+STANDARD_CHUNK_ROWS = 100_000
+
+# Part of every result cache key. Any change to the converters changes it, so results
+# cached by an older version are never used.
+CONVERTER_VERSION = source_version(__file__, utils.__file__, transactions.__file__)
+
+# How converted statements are handed back
+OUTPUT_MODES = {
+    'separate': "One file per statement",
+    'sheets': "One workbook, a sheet per statement",
+    'merged': "One workbook, all statements in one sheet",
+    'zip': "All files in one ZIP",
+}
+
+# Standard Bank code patterns in order of precedence. Pattern 13 may appear anywhere
+# in the line, the others only at the start. The first pattern that matches decides
+# the code, even if that code is then rejected because it is followed by ':'.
+STANDARD_CODE_PATTERNS = [
+    r'.*?\bDIV(?P<pattern13>\d{1,2})\b',        # Pattern 13: 'DIV' followed by one or two numbers
+    r'(?P<pattern6>\d{2}[A-Z]{3}\d{4})\b',      # Pattern 6: 2 numbers, 3 letters, 4 numbers
+    r'(?P<pattern2>\d{2}[A-Z]{4}\d{3})\b',      # Pattern 2: 2 numbers, 4 letters, 3 numbers
+    r'(?P<pattern1>\d{2}[A-Z]{3}\d{3})\b',      # Pattern 1: 2 numbers, 3 letters, 3 numbers
+    r'(?P<pattern7>[A-Z]{3}\d{4})\b',           # Pattern 7: 3 letters, 4 numbers
+    r'(?P<pattern8>[A-Z]{3}\d{3})\b',           # Pattern 8: 3 letters, 3 numbers
+    r'(?P<pattern3>\d[A-Z]{2}\d{3})\b',         # Pattern 3: 1 number, 2 letters, 3 numbers
+    r'(?P<pattern4>\d[A-Z]{3}\d{3})\b',         # Pattern 4: 1 number, 3 letters, 3 numbers
+    r'(?P<pattern5>[A-Z]{2}\d{4})\b',           # Pattern 5: 2 letters, 4 numbers
+    r'(?P<pattern9>\d[A-Z]{4}\d{2})\b',         # Pattern 9: 1 number, 4 letters, 2 numbers
+    r'(?P<pattern10>\d[A-Z]{4})\b',             # Pattern 10: 1 number, 4 letters
+    r'(?P<pattern11>[A-Z]{4}\d{2})\b',          # Pattern 11: 4 letters, 2 numbers
+    r'(?P<pattern14>\d[A-Z]{4}\d{4})\b',        # Pattern 14: 1 number, 4 letters, 4 numbers
+    r'(?P<pattern12>[A-Z]{3}\d{3})\b',          # Pattern 12: 3 letters, 3 numbers (shadowed by pattern 8)
+]
+
+# All patterns as one anchored alternation, so every line is scanned once and the
+# leftmost alternative that matches wins
+STANDARD_CODE_REGEX = re.compile('^(?:' + '|'.join(STANDARD_CODE_PATTERNS) + ')', re.DOTALL)
+
+
+def extract_first_match(lines, regex):
+    # One column per named group, only the group of the alternative that matched is filled in
+    matches = lines.str.extract(regex).to_numpy()
+    hits = pd.notna(matches)
+    first_hit = hits.argmax(axis=1)
+    matched = hits.any(axis=1)
+
+    codes = matches[np.arange(len(matches)), first_hit]
+    patterns = np.array(list(regex.groupindex), dtype=object)[first_hit]
+    return np.where(matched, codes, None), np.where(matched, patterns, None)
+
+
+def get_matching_codes(descriptions):
+    lines = descriptions.astype(str).str.strip()  # Ensure strings and remove any surrounding spaces
+    codes, patterns = extract_first_match(lines, STANDARD_CODE_REGEX)
+
+    # Reject codes that are followed by ':' anywhere in the line
+    keep = np.array([code is not None and code + ':' not in line for code, line in zip(codes, lines)], dtype=bool)
+
+    codes = pd.Series(np.where(keep, codes, None), index=descriptions.index, dtype=object)
+    patterns = pd.Series(np.where(keep, patterns, None), index=descriptions.index, dtype=object)
+    return codes, patterns
+
+
+# Prefixes removed from ABSA descriptions, longest first so the most specific one wins
+ABSA_REMOVE_PREFIXES = ['ACB DEBIT:EXTERNALSL-DEBITS', 'ACB DEBIT:EXTERNAL', 'DEBIT TRANSFER', 'ACB CREDIT']
+
+# 'DEBIT TRANSFER' followed by 6 numbers first, then at most one of the prefixes above
+ABSA_PREFIX_REGEX = re.compile(
+    r'^(?:DEBIT TRANSFER\d{6})?\s*(?:' + '|'.join(re.escape(prefix) for prefix in ABSA_REMOVE_PREFIXES) + r')?'
+)
+
+# ABSA code patterns in order of precedence. Unlike Standard Bank, the codes may appear
+# anywhere in the line (except pattern 14), and a pattern is searched through the whole
+# line before the next one is tried.
+ABSA_CODE_PATTERNS = [
+    r'.*?\bDIV(?P<pattern13>\d{1,2})\b',                # Pattern 13: 'DIV' followed by one or two numbers
+    r'.*?(?<!\w)(?P<pattern6>\d{2}[A-Z]{3}\d{4})(?!\w)',  # Pattern 6: 2 numbers, 3 letters, 4 numbers
+    r'.*?(?<!\w)(?P<pattern2>\d{2}[A-Z]{4}\d{3})(?!\w)',  # Pattern 2: 2 numbers, 4 letters, 3 numbers
+    r'.*?(?<!\w)(?P<pattern1>\d{2}[A-Z]{3}\d{3})(?!\w)',  # Pattern 1: 2 numbers, 3 letters, 3 numbers
+    r'.*?(?<!\w)(?P<pattern7>[A-Z]{3}\d{4})(?!\w)',        # Pattern 7: 3 letters, 4 numbers
+    r'.*?(?<!\w)(?P<pattern8>[A-Z]{3}\d{3})(?!\w)',        # Pattern 8: 3 letters, 3 numbers
+    r'.*?(?<!\w)(?P<pattern3>\d[A-Z]{2}\d{3})(?!\w)',     # Pattern 3: 1 number, 2 letters, 3 numbers
+    r'.*?(?<!\w)(?P<pattern4>\d[A-Z]{3}\d{3})(?!\w)',     # Pattern 4: 1 number, 3 letters, 3 numbers
+    r'.*?(?<!\w)(?P<pattern5>[A-Z]{2}\d{4})(?!\w)',        # Pattern 5: 2 letters, 4 numbers
+    r'.*?(?<!\w)(?P<pattern9>\d[A-Z]{4}\d{2})(?!\w)',     # Pattern 9: 1 number, 4 letters, 2 numbers
+    r'.*?(?<!\w)(?P<pattern10>\d[A-Z]{4})(?!\w)',          # Pattern 10: 1 number, 4 letters
+    r'.*?(?<!\w)(?P<pattern11>[A-Z]{4}\d{2})(?!\w)',       # Pattern 11: 4 letters, 2 numbers
+    r'(?P<pattern14>\d[A-Z]{4}\d{4})\b',                  # Pattern 14: 1 number, 4 letters, 4 numbers (start of line)
+    r'.*?(?<!\w)(?P<pattern12>[A-Z]{3}\d{3})(?!\w)',       # Pattern 12: 3 letters, 3 numbers (shadowed by pattern 8)
+]
+
+ABSA_CODE_REGEX = re.compile('^(?:' + '|'.join(ABSA_CODE_PATTERNS) + ')', re.DOTALL)
+
+
+def clean_absa_descriptions(descriptions):
+    # Descriptions must be text, the same as when every line was cleaned with re.sub
+    if len(descriptions) and pd.api.types.infer_dtype(descriptions, skipna=False) != 'string':
+        bad = next(line for line in descriptions if not isinstance(line, str))
+        raise TypeError(f"expected string or bytes-like object, got '{type(bad).__name__}'")
+
+    return descriptions.str.replace(ABSA_PREFIX_REGEX, '', n=1, regex=True).str.strip()
+
+
+def get_absa_codes(descriptions):
+    codes, patterns = extract_first_match(descriptions, ABSA_CODE_REGEX)
+    return (pd.Series(codes, index=descriptions.index, dtype=object),
+            pd.Series(patterns, index=descriptions.index, dtype=object))
+
+
+# Lines found by every pattern of the regex, in order of precedence, and the lines
+# that got no code
+def count_pattern_hits(patterns, regex):
+    hits = patterns.value_counts().reindex(list(regex.groupindex), fill_value=0)
+    return {**{pattern: int(count) for pattern, count in hits.items()}, 'no code': int(patterns.isna().sum())}
+
+
+# Master file lookup from CODE1 to DESCRIPTION. When a code appears more than once
+# the first description in the master file is used.
+def build_master_index(df_masterfile):
+    master_descriptions = df_masterfile.drop_duplicates(subset='CODE1', keep='first')
+    return pd.Series(master_descriptions['DESCRIPTION'].values, index=master_descriptions['CODE1'].values)
+
+
+def read_master_file(source):
+    df_masterfile = pd.read_excel(source)
+    df_masterfile.columns = ['CODE1', 'DESCRIPTION']
+    return df_masterfile
+
+
+# Parsed master files are cached by a hash of their contents, so reruns and re-uploads
+# of the same file don't parse the workbook again
+@st.cache_resource(max_entries=MASTER_CACHE_ENTRIES, show_spinner="Loading master file...")
+def load_master_index(file_hash, _file_bytes):
+    df_masterfile = read_master_file(io.BytesIO(_file_bytes))
+    duplicate_codes = int(df_masterfile['CODE1'].duplicated().sum())
+    return build_master_index(df_masterfile), duplicate_codes
+
+
+# Result cache key of a statement, None when the statement can't be read. The key
+# covers the statement, the bank, the converter version and anything else the result
+# depends on, like the master file.
+def statement_cache_key(file, bank_type, *parts):
+    try:
+        with open(file, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return result_cache_key(data, bank_type, CONVERTER_VERSION, *parts)
+
+
+# Master file part of the Standard Bank cache keys
+def master_cache_key(master_descriptions):
+    return result_cache_key(pd.util.hash_pandas_object(master_descriptions).to_numpy().tobytes())
+
+
+# Convert a statement with try_convert, unless the same statement was converted before.
+# Only successful conversions are cached, the converted frame keeps its key so the
+# files written from it are cached too. While auditing every statement is converted, so
+# its lines are written.
+def try_convert_cached(file, try_convert, bank_type, *key_parts):
+    key = statement_cache_key(file, bank_type, *key_parts)
+    df = get_cached_result(key) if key and not auditing() else None
+    if df is not None:
+        return df, None
+
+    df, error = try_convert(file)
+    if error is None and key:
+        df.attrs['result_key'] = key
+        cache_result(key, df)
+    return df, error
+
+
+# Name of the converted file for one statement, the bank's usual name when there is only one
+def output_file_name(stem, statement, several, output_format='xlsx'):
+    if several:
+        stem = f"{stem} {os.path.splitext(os.path.basename(statement))[0]}"
+    return stem + OUTPUT_FORMATS[output_format][0]
+
+
+# The converted statement in one output format. Streamed statements were already written
+# in every format while they were converted.
+def statement_output(statement, output, output_format):
+    if isinstance(output, dict):
+        return output[output_format]
+
+    key = output.attrs.get('result_key')
+    data = get_cached_result(result_cache_key(key, output_format)) if key else None
+    if data is None:
+        with stage_source(statement), stage(f"write {output_format}") as record:
+            data = to_format_bytes(format_transactions(output), output_format)
+            record['rows'] = len(output)
+        if key:
+            cache_result(result_cache_key(key, output_format), data)
+    return data
+
+
+# Build the files that hand the converted statements to the user. outputs holds (statement,
+# transactions frame) pairs, or for streamed statements a dict of output format -> finished
+# file. Returns the downloads, problems are added to messages.
+def build_downloads(outputs, output_mode, stem, label, messages, save_copy=False, output_formats=('xlsx',)):
+    downloads = []
+    if not outputs:
+        return downloads
+    several = len(outputs) > 1
+
+    def add_download(data, file_name, file_label, mime):
+        if save_copy:
+            save_output_copy(data, file_name)
+        downloads.append(download(data, file_name, file_label, mime))
+
+    # Streamed statements are already finished files, so they can't be combined into one
+    if output_mode in ('sheets', 'merged') and any(isinstance(output, dict) for _, output in outputs):
+        messages.append(('info', "Streamed statements can't be combined into one file, "
+                                 "they are downloaded as a ZIP file."))
+        output_mode = 'zip'
+
+    if output_mode == 'separate':
+        job_progress(total=len(outputs) * len(output_formats))
+        for statement, output in outputs:
+            for output_format in output_formats:
+                name = output_file_name(stem, statement, several, output_format)
                 try:
-                    return pd.to_datetime(date, format='%Y%m%d').strftime('%d/%m/%Y')
-                except Exception:
-                    return date
-
-            df_with_codes['DATE'] = df_with_codes['DATE'].apply(format_date)
-            df_without_codes['DATE'] = df_without_codes['DATE'].apply(format_date)
-
-            # Process amounts
-            for df_part in [df_with_codes, df_without_codes]:
-                df_part['CREDIT'] = np.where(df_part['AMOUNT'] > 0, df_part['AMOUNT'], 0)
-                df_part['DEBIT'] = np.where(df_part['AMOUNT'] < 0, -df_part['AMOUNT'], 0)
-                df_part.drop('AMOUNT', axis=1, inplace=True)
-
-            # Final ordering
-            final_order = ['DATE', 'DESCRIPTION_CODE', 'CODE1', 'DEBIT', 'CREDIT', 'original_index']
-            df_with_codes = df_with_codes[final_order]
-            df_without_codes = df_without_codes[final_order]
-
-            # Concatenate and return
-            df_combined = pd.concat([df_without_codes, df_with_codes]).sort_values(by='original_index').reset_index(
-                drop=True)
-            df_combined.drop('original_index', axis=1, inplace=True)
-
-            output_path = os.path.join("temp", "final_output_standard.xlsx")
-            df_combined.to_excel(output_path, index=False)
-
-            with open(output_path, "rb") as file:
-                st.download_button(
-                    label="Download Standard Bank Processed File",
-                    data=file,
-                    file_name="final_output_standard.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-
-        except Exception as e:
-            st.error(f"Failed to save the file: {e}")
-
-    st.write("Standard Bank files have been processed successfully.")
-    file_list.clear()
-# Define your file processing function for ABSA Bank
-def process_absa_bank_files(file_list, df_masterfile):
-    #declare removable strings
-    remove_list = ['ACB DEBIT:EXTERNALSL-DEBITS', 'ACB DEBIT:EXTERNAL', 'DEBIT TRANSFER', 'ACB CREDIT']
-    debit_pattern = r'^DEBIT TRANSFER\d{6}'
-
-    for file in file_list:
+                    data = statement_output(statement, output, output_format)
+                    add_download(data, name, f"{label} ({name})" if several or len(output_formats) > 1 else label,
+                                 OUTPUT_FORMATS[output_format][1])
+                except Exception as e:
+                    messages.append(('error', f"Failed to save the file: {e}"))
+                job_progress(done=1)
+        return downloads
+
+    if output_mode == 'zip':
+        job_progress(total=1)
         try:
-            df_absa = pd.read_csv(file, header=None)
-
-            # Expected column indices
-            expected_columns = [2, 4, 5, 6]
-
-            # Ensure the DataFrame has enough columns
-            if df_absa.shape[1] < max(expected_columns) + 1:
-                raise ValueError(
-                    f"File does not have enough columns. Expected at least {max(expected_columns) + 1} columns.")
-
-            # Select only the relevant columns
-            df_absa = df_absa.iloc[:, expected_columns]
-
-            # Rename columns
-            df_absa.columns = ['DATE', 'DESCRIPTION', 'CODE', 'AMOUNT']
-            df_absa['original_index'] = df_absa.index
-
-            #remove debit_transfer followed by numbers first
-            def remove_debit_transfer(line):
-                return re.sub(debit_pattern, '', line).strip()  # Removes the match and strips extra spaces
-
-            df_absa['DESCRIPTION'] = df_absa['DESCRIPTION'].apply(remove_debit_transfer)
-
-            #remove unnecessary description
-            def remove_starting_strings(line, remove_list):
-                for string in remove_list:
-                    if line.startswith(string):
-                        return line[len(string):].lstrip()  # Remove string and leading spaces
-                return line
-            # Apply the function to the column
-            df_absa['DESCRIPTION'] = df_absa['DESCRIPTION'].apply(lambda x: remove_starting_strings(x, remove_list))
-
-            #find codes
-            def get_matching_code(line):
-                line = str(line).strip()  # Ensure it's a string and remove any surrounding spaces
-
-                # Pattern 12: 'DIV' followed by one or two numbers (anywhere in line, but not part of another word)
-                match13 = re.search(r'\bDIV(\d{1,2})\b', line)
-                if match13:
-                    code = match13.group(1)  # Extract only the number part
-                    return code
-                # Pattern 6: 2 numbers, 3 letters, 4 numbers (anywhere in line, but not part of another word)
-                match6 = re.search(r'(?<!\w)\d{2}[A-Z]{3}\d{4}(?!\w)', line)
-                if match6:
-                    code = match6.group(0)
-                    return code
-
-                # Pattern 2: 2 numbers, 4 letters, 3 numbers (anywhere in line, but not part of another word)
-                match2 = re.search(r'(?<!\w)\d{2}[A-Z]{4}\d{3}(?!\w)', line)
-                if match2:
-                    code = match2.group(0)
-                    return code
-
-                # Pattern 1: 2 numbers, 3 letters, 3 numbers (anywhere in line, but not part of another word)
-                match1 = re.search(r'(?<!\w)\d{2}[A-Z]{3}\d{3}(?!\w)', line)
-                if match1:
-                    code = match1.group(0)
-                    return code
-
-                # Pattern 7: 3 letters, 4 numbers (anywhere in line, but not part of another word)
-                match7 = re.search(r'(?<!\w)[A-Z]{3}\d{4}(?!\w)', line)
-                if match7:
-                    code = match7.group(0)
-                    return code
-
-                # Pattern 8: 3 letters, 3 numbers (anywhere in line, but not part of another word)
-                match8 = re.search(r'(?<!\w)[A-Z]{3}\d{3}(?!\w)', line)
-                if match8:
-                    code = match8.group(0)
-                    return code
-
-                # Pattern 3: 1 number, 2 letters, 3 numbers (anywhere in line, but not part of another word)
-                match3 = re.search(r'(?<!\w)\d[A-Z]{2}\d{3}(?!\w)', line)
-                if match3:
-                    code = match3.group(0)
-                    return code
-
-                # Pattern 4: 1 number, 3 letters, 3 numbers (anywhere in line, but not part of another word)
-                match4 = re.search(r'(?<!\w)\d[A-Z]{3}\d{3}(?!\w)', line)
-                if match4:
-                    code = match4.group(0)
-                    return code
-
-                # Pattern 5: 2 letters, 4 numbers (anywhere in line, but not part of another word)
-                match5 = re.search(r'(?<!\w)[A-Z]{2}\d{4}(?!\w)', line)
-                if match5:
-                    code = match5.group(0)
-                    return code
-
-                # Pattern 9: 1 number, 4 letters, 2 numbers (anywhere in line, but not part of another word)
-                match9 = re.search(r'(?<!\w)\d[A-Z]{4}\d{2}(?!\w)', line)
-                if match9:
-                    code = match9.group(0)
-                    return code
-
-                # Pattern 10: 1 number, 4 letters (anywhere in line, but not part of another word)
-                match10 = re.search(r'(?<!\w)\d[A-Z]{4}(?!\w)', line)
-                if match10:
-                    code = match10.group(0)
-                    return code
-
-                # Pattern 11: 4 letters, 2 numbers (anywhere in line, but not part of another word)
-                match11 = re.search(r'(?<!\w)[A-Z]{4}\d{2}(?!\w)', line)
-                if match11:
-                    code = match11.group(0)
-                    return code
-
-                # Pattern 14: 4 letters, 4 numbers (start of line)
-                match14 = re.search(r'^\d[A-Z]{4}\d{4}\b', line)
-                if match14:
-                    code = match14.group(0)
-                    return code
-
-                # Pattern 12: 3 letters, 3 numbers (anywhere in line, but not part of another word)
-                match12 = re.search(r'(?<!\w)[A-Z]{3}\d{3}(?!\w)', line)
-                if match12:
-                    code = match12.group(0)
-                    return code
-
-                return None
-
-            # Apply regex to extract codes and add them to a new 'CODE' column
-            df_absa['CODE'] = df_absa['DESCRIPTION'].apply(get_matching_code)
-
-            # Fix df_absa
-            final_order = ['DATE', 'DESCRIPTION', 'CODE', 'AMOUNT', 'original_index']
-            df_absa = df_absa[final_order]
-
-            # DEBIT and CREDIT
-            df_absa['DEBIT'] = np.where(df_absa['AMOUNT'] < 0, -df_absa['AMOUNT'], 0)
-            df_absa['CREDIT'] = np.where(df_absa['AMOUNT'] > 0, df_absa['AMOUNT'], 0)
-            df_absa.drop('AMOUNT', axis='columns', inplace=True)
-            df_absa.drop('original_index', axis='columns', inplace=True)
-
-            # FIX DATE
-            df_absa['DATE'] = df_absa['DATE'].astype(str)  # Convert the column to string
-            df_absa['DATE'] = pd.to_datetime(df_absa['DATE'], format='%y%m%d', errors='coerce').dt.strftime(
-                '%d/%m/%Y').fillna(df_absa['DATE'])
-
-            try:
-                output_path = os.path.join("temp", "final_output_ABSA.xlsx")
-                df_absa.to_excel(output_path, index=False)
-
-                with open(output_path, "rb") as file:
-                    st.download_button(
-                        label="Download ABSA Bank Processed File",
-                        data=file,
-                        file_name="final_output_standard.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-
-            except Exception as e:
-                st.error(f"Failed to save the file: {e}")
-
+            files = {output_file_name(stem, statement, several, output_format):
+                     statement_output(statement, output, output_format)
+                     for statement, output in outputs for output_format in output_formats}
+            add_download(to_zip_bytes(files), f"{stem}.zip", label, ZIP_MIME)
         except Exception as e:
-            st.error(f"Error processing file {file}: {e}")
-    file_list.clear()
-
+            messages.append(('error', f"Failed to save the file: {e}"))
+        job_progress(done=1)
+        return downloads
 
-def process_capitec_bank_files(file_list):
-    for file in file_list:
-        try:
-            # Read CSV file and skip the first 3 lines
-            df_capitec = pd.read_csv(file, header=None, engine='python', skiprows=3)
-        except Exception as e:
-            st.error(f"Error reading file {file}: {e}")
-            continue  # Skip the current file and continue with the rest
-
-        # Validate columns
-        expected_columns = [1, 2, 3, 4, 5]
-        if df_capitec.shape[1] < max(expected_columns) + 1:
-            st.error(f"File does not have enough columns. Expected at least {max(expected_columns) + 1} columns.")
-            continue  # Skip this file and continue with the next
-
-        # Extract Fees, Date, and Description
-        fees = df_capitec.iloc[-1, 5]
-        date = df_capitec.iloc[-2, 1]
-        description = df_capitec.iloc[-2, 2]
-
-        # Select relevant columns and clean up
-        df_capitec = df_capitec.iloc[:, [1, 3, 4, 5]]
-        df_capitec.reset_index(drop=True, inplace=True)
-        df_capitec.columns = ['DATE', 'REFERENCE', 'AMOUNT', 'FEES']
-        df_capitec.drop(columns='FEES', inplace=True)
-
-        # Remove the last two rows (summary rows)
-        df_capitec = df_capitec.iloc[:-2]
-
-        # Convert 'AMOUNT' to numeric
-        df_capitec['AMOUNT'] = pd.to_numeric(df_capitec['AMOUNT'], errors='coerce').fillna(0)
-
-        # Create 'DEBIT' and 'CREDIT' columns
-        df_capitec['DEBIT'] = np.where(df_capitec['AMOUNT'] < 0, -df_capitec['AMOUNT'], 0)
-        df_capitec['CREDIT'] = np.where(df_capitec['AMOUNT'] > 0, df_capitec['AMOUNT'], 0)
-        df_capitec.drop(columns='AMOUNT', inplace=True)
-
-        # Extract site information from 'REFERENCE'
-        # Extract the 'D' followed by exactly three digits from 'REFERENCE'
-        pattern = r'(D\d{3})'
-        df_capitec['SITE'] = df_capitec['REFERENCE'].str.extract(pattern, expand=False).fillna("")
-
-        # Extract and process activity codes
-        df_capitec['activity_letter'] = df_capitec['REFERENCE'].str[5:6]
-        df_capitec['ACTIVITY'] = ""
-        df_capitec.loc[df_capitec['activity_letter'] == 'B', 'ACTIVITY'] = "B8200"
-        df_capitec.loc[df_capitec['activity_letter'] == 'C', 'ACTIVITY'] = "C1200"
-        df_capitec.drop(columns='activity_letter', inplace=True)
-
-        # Append "EFT WAGES" to debit transactions
-        df_capitec.loc[df_capitec['DEBIT'] > 0, 'REFERENCE'] = (
-                "EFT WAGES " + df_capitec.loc[df_capitec['DEBIT'] > 0, 'REFERENCE']
-        )
-
-        # Reorder columns
-        final_order = ['DATE', 'REFERENCE', 'SITE', 'ACTIVITY', 'DEBIT', 'CREDIT']
-        df_capitec = df_capitec[final_order]
-
-        # Add back last row
-        last_row = pd.Series(
-            [date, description, '', '', fees, 0],
-            index=df_capitec.columns
-        )
-        df_capitec = pd.concat([df_capitec, last_row.to_frame().T], ignore_index=True)
-
-        # Try saving the final output to Excel
+    job_progress(total=len(output_formats))
+    for output_format in output_formats:
         try:
-            output_path = os.path.join("temp", "final_output_CAPITEC.xlsx")
-            df_capitec.to_excel(output_path, index=False)
-
-            # Streamlit download button
-            with open(output_path, "rb") as file:
-                st.download_button(
-                    label="Download CAPITEC Bank Processed File",
-                    data=file,
-                    file_name="final_output_standard.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            with stage_source("all statements"), stage(f"write {output_mode} {output_format}") as record:
+                data, name, mime = build_combined_output(outputs, output_mode, stem, output_format)
+                record['rows'] = sum(len(df) for _, df in outputs)
+            add_download(data, name, f"{label} ({name})" if len(output_formats) > 1 else label, mime)
         except Exception as e:
-            st.error(f"Failed to save the file: {e}")
-
-    # Clear the file list after processing all files
-    file_list.clear()
+            messages.append(('error', f"Failed to save the file: {e}"))
+        job_progress(done=1)
+    return downloads
+
+
+# One file with every converted statement. Returns the data, file name and MIME type.
+def build_combined_output(outputs, output_mode, stem, output_format):
+    if output_mode == 'sheets':
+        # One sheet per statement, named after the statement
+        sheet_names = excel_sheet_names([os.path.splitext(os.path.basename(statement))[0]
+                                         for statement, _ in outputs])
+        return to_format_sheets(dict(zip(sheet_names, (format_transactions(df) for _, df in outputs))),
+                                output_format, stem)
+
+    # All statements in one ledger, with the statement each row came from
+    merged = pd.concat([format_transactions(df).assign(STATEMENT=os.path.basename(statement))
+                        for statement, df in outputs], ignore_index=True)
+    merged = merged[['STATEMENT', *merged.columns[:-1]]]
+    extension, mime = OUTPUT_FORMATS[output_format]
+    return to_format_bytes(merged, output_format), stem + extension, mime
+
+
+# Columns read as text, every column but the date and the amount. Descriptions are text
+# even when a chunk happens to have none, and the other columns are written to the audit
+# files as they are in the statement.
+STANDARD_TEXT_COLUMNS = [0, 2, 4, 5, 6, 7]
+
+
+# Record types (column 2) of the header and balance records in a statement. They are
+# never matched to a code, only the transactions are.
+STANDARD_NON_TRANSACTION_TYPES = ['BRANCH', 'ACC-NO', 'OPEN', 'CLOSE']
+
+
+# Read the text file with all 8 columns, in chunks of rows when a chunksize is given
+def read_standard_bank_file(file, chunksize=None):
+    return pd.read_csv(file, header=None, dtype=dict.fromkeys(STANDARD_TEXT_COLUMNS, str), chunksize=chunksize)
+
+
+def convert_standard_bank_frame(df, master_descriptions):
+    # The statement lines as they were read, for the audit files
+    lines = df
+
+    # Drop unnecessary columns (0, 2, 4, 6, 7)
+    df = df.drop(columns=[0, 2, 4, 6, 7])
+
+    # Rename remaining columns to 'DATE', 'AMOUNT', 'DESCRIPTION'
+    df.columns = ['DATE', 'AMOUNT', 'DESCRIPTION']
+    descriptions = df['DESCRIPTION'].str.strip()  # Remove leading/trailing spaces
+
+    # Tell the transactions from the header and balance records by their record type
+    with stage("classify records") as record:
+        record_types = lines[2].str.strip()
+        is_transaction = ~record_types.isin(STANDARD_NON_TRANSACTION_TYPES)
+        record['rows'] = len(lines)
+        record['record_types'] = {record_type: int(count) for record_type, count in record_types.value_counts().items()}
+
+    # Apply regex and extract matching codes, the first 6 characters are never part of a code.
+    # The other records keep their place in the statement, without a code.
+    with stage("match codes") as record:
+        codes, patterns = get_matching_codes(descriptions[is_transaction].str[6:])
+        record['rows'] = len(codes)
+        record['patterns'] = count_pattern_hits(patterns, STANDARD_CODE_REGEX)
+        codes, patterns = codes.reindex(df.index), patterns.reindex(df.index)
+    if auditing():
+        with stage("write audit") as record:
+            write_audit_lines(lines, codes, patterns)
+            record['rows'] = len(lines)
+
+    # Look up the master description and code for every row that has a code
+    with stage("master lookup") as record:
+        has_code = codes.notnull()
+        master_codes = codes.where(codes.isin(master_descriptions.index))
+        description_codes = descriptions.fillna('')
+        description_codes[has_code] = codes[has_code].map(master_descriptions).fillna('') + ' ' + codes[has_code]
+        record['rows'] = int(has_code.sum())
+
+    # Ensure numeric amount
+    amounts = pd.to_numeric(df['AMOUNT'], errors='coerce').fillna(0)
+
+    # Rows stay in the order of the statement
+    with stage("build transactions") as record:
+        df_transactions = transaction_frame('standard', df['DATE'], '%Y%m%d', description_codes, master_codes, amounts)
+        record['rows'] = len(df_transactions)
+    return df_transactions
+
+
+def convert_standard_bank_file(file, master_descriptions):
+    with stage("read") as record:
+        df = read_standard_bank_file(file)
+        record['rows'] = len(df)
+    return convert_standard_bank_frame(df, master_descriptions)
+
+
+# Convert a statement a fixed number of rows at a time, so very large statements never
+# have to be in memory all at once
+def convert_standard_bank_chunks(file, master_descriptions, chunksize=STANDARD_CHUNK_ROWS):
+    with read_standard_bank_file(file, chunksize) as reader:
+        for chunk in reader:
+            yield format_transactions(convert_standard_bank_frame(chunk, master_descriptions))
+
+
+def try_convert_standard_bank_file(file, master_descriptions):
+    try:
+        return convert_standard_bank_file(file, master_descriptions), None
+    except Exception as e:
+        return None, f"Failed to save the file: {e}"
+
+
+# Convert the statements and build their downloads without showing anything, so it can
+# run as a job. Returns what the page shows afterwards.
+def convert_standard_bank_files(file_list, master_descriptions, chunksize=None, save_copy=False,
+                                output_mode='separate', show_details=False, output_formats=('xlsx',)):
+    outputs = []
+    messages = []
+    master_key = master_cache_key(master_descriptions)
+    with record_stages(stages_enabled(show_details), show_details) as records:
+        if chunksize:
+            # In streaming mode statements are converted one at a time and every chunk is
+            # written as soon as it is converted
+            job_progress(total=len(file_list))
+            for file in file_list:
+                # Finished files of a statement that was converted before are reused
+                key = statement_cache_key(file, 'standard', master_key)
+                cached = {output_format: get_cached_result(result_cache_key(key, output_format))
+                          if key and not auditing() else None for output_format in output_formats}
+                if all(data is not None for data in cached.values()):
+                    outputs.append((file, cached))
+                    job_progress(done=1)
+                    continue
 
+                try:
+                    files = {output_format: io.BytesIO() for output_format in output_formats}
+                    with stage_source(file):
+                        write_chunks(convert_standard_bank_chunks(file, master_descriptions, chunksize),
+                                     open_chunk_writers(files))
+                    output = {output_format: f.getvalue() for output_format, f in files.items()}
+                    if key:
+                        for output_format, data in output.items():
+                            cache_result(result_cache_key(key, output_format), data)
+                    outputs.append((file, output))
+                except Exception as e:
+                    messages.append(('error', f"Failed to save the file: {e}"))
+                job_progress(done=1)
+        else:
+            results = convert_concurrently(
+                lambda file: try_convert_cached(
+                    file, lambda f: try_convert_standard_bank_file(f, master_descriptions), 'standard', master_key),
+                file_list)
+            outputs = converted_outputs(file_list, results, messages)
+
+        downloads = build_downloads(outputs, output_mode, "final_output_standard",
+                                    "Download Standard Bank Processed File", messages, save_copy, output_formats)
+    messages.append(('write', "Standard Bank files have been processed successfully."))
+    return {'messages': messages, 'downloads': downloads, 'records': records, 'show_details': show_details}
+
+
+# Statements that converted, the errors of the others are added to messages
+def converted_outputs(file_list, results, messages):
+    outputs = []
+    for file, (df, error) in zip(file_list, results):
+        if error:
+            messages.append(('error', error))
+        else:
+            outputs.append((file, df))
+    return outputs
+
+
+def convert_absa_bank_file(file):
+    with stage("read") as record:
+        df_absa = pd.read_csv(file, header=None)
+        record['rows'] = len(df_absa)
+
+    # Expected column indices
+    expected_columns = [2, 4, 5, 6]
+
+    # Ensure the DataFrame has enough columns
+    if df_absa.shape[1] < max(expected_columns) + 1:
+        raise ValueError(
+            f"File does not have enough columns. Expected at least {max(expected_columns) + 1} columns.")
+
+    # Select only the relevant columns, the statement lines as they were read are kept for
+    # the audit files
+    lines = df_absa
+    df_absa = df_absa.iloc[:, expected_columns]
+
+    # Rename columns
+    df_absa.columns = ['DATE', 'DESCRIPTION', 'CODE', 'AMOUNT']
+
+    # Remove unnecessary description prefixes and extract codes
+    with stage("clean descriptions") as record:
+        descriptions = clean_absa_descriptions(df_absa['DESCRIPTION'])
+        record['rows'] = len(df_absa)
+    with stage("match codes") as record:
+        codes, patterns = get_absa_codes(descriptions)
+        record['rows'] = len(df_absa)
+        record['patterns'] = count_pattern_hits(patterns, ABSA_CODE_REGEX)
+    if auditing():
+        with stage("write audit") as record:
+            write_audit_lines(lines, codes, patterns)
+            record['rows'] = len(lines)
+
+    # Dates are read as text in the yymmdd format
+    with stage("build transactions") as record:
+        df_transactions = transaction_frame('absa', df_absa['DATE'].astype(str), '%y%m%d', descriptions, codes,
+                                            df_absa['AMOUNT'])
+        record['rows'] = len(df_transactions)
+    return df_transactions
+
+
+def try_convert_absa_bank_file(file):
+    try:
+        return convert_absa_bank_file(file), None
+    except Exception as e:
+        return None, f"Error processing file {file}: {e}"
+
+
+# Capitec site, the 'D' followed by exactly three digits in the reference
+CAPITEC_SITE_REGEX = re.compile(r'(D\d{3})')
+
+
+# Columns used from a Capitec statement: date, description, reference, amount and fees
+CAPITEC_COLUMNS = [1, 2, 3, 4, 5]
+CAPITEC_COLUMNS_ERROR = f"File does not have enough columns. Expected at least {max(CAPITEC_COLUMNS) + 1} columns."
+
+
+def read_capitec_bank_file(file):
+    # Skip the first 3 lines and read with the C parser. Every column is read, so a row
+    # with more fields than the others is an error and never shifts its amounts. The last
+    # two rows are the fee line and the totals, they are split off in the conversion.
+    return pd.read_csv(file, header=None, skiprows=3)
+
+
+def convert_capitec_bank_file(df_capitec):
+    # Validate columns, the frame is labelled by the column positions in the file
+    if not set(CAPITEC_COLUMNS).issubset(df_capitec.columns):
+        raise ValueError(CAPITEC_COLUMNS_ERROR)
+
+    # Extract Fees, Date, and Description from the footer, the fee line and the totals
+    if len(df_capitec) < 2:
+        raise ValueError("File does not end with the fee and total rows.")
+    footer = df_capitec.iloc[-2:]
+    fees = footer[5].iloc[-1]
+    date = footer[1].iloc[0]
+    description = footer[2].iloc[0]
+
+    # The transactions, without the footer
+    body = df_capitec.iloc[:-2]
+    reference = body[3]
+
+    # Convert 'AMOUNT' to numeric
+    amount = pd.to_numeric(body[4], errors='coerce').fillna(0)
+
+    # Extract site information from 'REFERENCE'
+    site = reference.str.extract(CAPITEC_SITE_REGEX, expand=False).fillna("")
+
+    # Extract and process activity codes
+    activity_letter = reference.str[5:6]
+    activity = np.select([activity_letter == 'B', activity_letter == 'C'], ["B8200", "C1200"], "")
+
+    # Append "EFT WAGES" to debit transactions
+    reference = np.where(amount < 0, "EFT WAGES " + reference, reference)
+
+    # The fee line is written as the last row
+    df_transactions = transaction_frame('capitec', body[1], OUTPUT_DATE_FORMAT, reference, None, amount,
+                                        {'SITE': site, 'ACTIVITY': activity})
+    df_transactions.attrs['summary_row'] = {'DATE': date, 'REFERENCE': description, 'SITE': '', 'ACTIVITY': '',
+                                            'DEBIT': fees, 'CREDIT': 0}
+    return df_transactions
+
+
+def try_convert_capitec_bank_file(file):
+    try:
+        with stage("read") as record:
+            df_capitec = read_capitec_bank_file(file)
+            record['rows'] = len(df_capitec)
+    except Exception as e:
+        return None, f"Error reading file {file}: {e}"
+
+    # Validate columns, before only the used ones are kept
+    if df_capitec.shape[1] < max(CAPITEC_COLUMNS) + 1:
+        return None, CAPITEC_COLUMNS_ERROR
+    df_capitec = df_capitec[CAPITEC_COLUMNS]
+
+    try:
+        with stage("convert") as record:
+            df_capitec = convert_capitec_bank_file(df_capitec)
+            record['rows'] = len(df_capitec)
+        return df_capitec, None
+    except ValueError as e:
+        return None, str(e)
+    except Exception as e:
+        # Any other error fails only this statement, the others are still converted
+        return None, f"Error processing file {file}: {e}"
+
+
+# Converter of one statement, name of the converted file and download label of the banks
+# whose statements are converted the same way
+BANK_CONVERTERS = {
+    'absa': (try_convert_absa_bank_file, "final_output_ABSA", "Download ABSA Bank Processed File"),
+    'capitec': (try_convert_capitec_bank_file, "final_output_CAPITEC", "Download CAPITEC Bank Processed File"),
+}
+
+
+# Convert the statements of a bank in BANK_CONVERTERS and build their downloads without
+# showing anything, so it can run as a job. Returns what the page shows afterwards.
+def convert_bank_files(file_list, bank_type, save_copy=False, output_mode='separate', show_details=False,
+                       output_formats=('xlsx',)):
+    try_convert, stem, label = BANK_CONVERTERS[bank_type]
+    messages = []
+    with record_stages(stages_enabled(show_details), show_details) as records:
+        results = convert_concurrently(lambda file: try_convert_cached(file, try_convert, bank_type), file_list)
+        outputs = converted_outputs(file_list, results, messages)
+        downloads = build_downloads(outputs, output_mode, stem, label, messages, save_copy, output_formats)
+    return {'messages': messages, 'downloads': downloads, 'records': records, 'show_details': show_details}
+
+
+# Start a job that converts the uploaded statements with convert(file_list, *args, **kwargs).
+# The statements are saved in a folder of the job's own, which is deleted once the job is
+# finished or cancelled. Every upload has a folder in it, so statements with the same name
+# are kept apart.
+def start_upload_job(name, convert, uploaded_files, *args, **kwargs):
+    upload_dir = os.path.join(UPLOAD_DIR, uuid.uuid4().hex)
+    file_list = []
+    for uploaded_file in uploaded_files:
+        file_path = os.path.join(upload_dir, uploaded_file.file_id, uploaded_file.name)
+        os.makedirs(os.path.dirname(file_path))
+        with open(file_path, "wb") as f:
+            f.write(uploaded_file.getbuffer())
+        file_list.append(file_path)
 
-from pages import AVBOB  # Import your avbob module from the pages directory
+    job = start_job('banks', name, convert, file_list, *args, **kwargs)
+    job['future'].add_done_callback(lambda future: shutil.rmtree(upload_dir, ignore_errors=True))
+    return job
 
 
 # Add navigation sidebar
@@ -529,50 +663,80 @@ def main():
     # Select Bank Type
     bank_type = st.radio("", (std_bank, abs_bank, cpt_bank))
 
-    file_list = []
-
-    # Upload Text File button
-    uploaded_text_file = st.file_uploader("Upload Bank Statement", type=["txt", "csv", "xlsx"])
-    if uploaded_text_file is not None:
-        # Save the text file in file_list
-        file_path = os.path.join("temp", uploaded_text_file.name)  # Save temporarily
-        with open(file_path, "wb") as f:
-            f.write(uploaded_text_file.getbuffer())
-        file_list.append(file_path)
+    # Upload Text File button, any number of statements from the same bank. They are only
+    # saved once 'Go' starts a job for them.
+    uploaded_text_files = st.file_uploader("Upload Bank Statements", type=["txt", "csv", "xlsx"],
+                                           accept_multiple_files=True) or []
 
     # Upload Master File button (only if Standard Bank is selected)
+    master_descriptions = None
+    stream_statement = False
     if bank_type == std_bank:
+        stream_statement = st.checkbox("Streaming mode (for very large statements)")
         uploaded_master_file = st.file_uploader("Upload Master File (Excel)", type=["xlsx", "xls"])
         if uploaded_master_file is not None:
-            # Save and load the master file into df_masterfile
-            file_path = os.path.join("temp", uploaded_master_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_master_file.getbuffer())
-            global df_masterfile
+            # Load the master file lookup, reusing the parsed file if it was seen before
+            file_bytes = uploaded_master_file.getvalue()
             try:
-                df_masterfile = pd.read_excel(file_path)
-                df_masterfile.columns = ['CODE1', 'DESCRIPTION']
+                master_descriptions, duplicate_codes = load_master_index(hashlib.sha256(file_bytes).hexdigest(),
+                                                                         file_bytes)
+
+                # Codes that appear more than once only use their first description
+                if duplicate_codes:
+                    st.warning(f"The master file has {duplicate_codes} duplicate codes, "
+                               f"the first description is used for each.")
             except Exception as e:
                 st.error(f"Failed to load the master file: {e}")
 
-    # 'Go' button to process files
-    if st.button("Go"):
-        if bank_type == std_bank:
-            if df_masterfile is None:
-                st.error("Please upload the master file for Standard Bank.")
-            elif df_masterfile is not None and file_list:
-                process_standard_bank_files(file_list, df_masterfile)
-            else:
-                st.error("Please upload the correct files before processing.")
-        elif bank_type == abs_bank:
-            if file_list:
-                process_absa_bank_files(file_list, df_masterfile)  # No need to check master file for ABSA
-            else:
-                st.error("Please upload the correct files before processing.")
-        elif bank_type == cpt_bank:
-            if file_list:
-                process_capitec_bank_files(file_list)  # No need to check master file for CAPITEC
+    # How the converted statements are handed back when there is more than one
+    output_mode = 'separate'
+    if len(uploaded_text_files) > 1:
+        output_mode = st.radio("Output", list(OUTPUT_MODES), format_func=OUTPUT_MODES.get)
+
+    output_formats = select_output_formats()
 
+    # Converted files are only kept on disk when asked for
+    save_copy = st.checkbox("Also save a copy of the converted file in temp/")
+    show_details = st.checkbox("Show performance details")
+
+    # Lines with and without a code are written per run and statement, to tune the master file
+    audit = False
+    if bank_type in (std_bank, abs_bank):
+        audit = st.checkbox(f"Write the matched and unmatched lines to a new folder in {AUDIT_DIR} for every run")
+
+    # Statements converted before come from the result cache, clearing it converts them again
+    cached_results, cached_bytes = result_cache_size()
+    if cached_results and st.button(f"Clear cached results ({cached_results}, {cached_bytes / 2 ** 20:.1f} MB)"):
+        clear_result_cache()
+        st.success("Cached results cleared.")
+
+    # 'Go' starts the conversion as a job. It runs in the background, so reruns of the page
+    # don't stop it, and its downloads stay on the page until they are cleared.
+    if st.button("Go"):
+        options = dict(save_copy=save_copy, output_mode=output_mode, show_details=show_details,
+                       output_formats=output_formats)
+        name = f"{bank_type}: {', '.join(uploaded_file.name for uploaded_file in uploaded_text_files)}"
+        with audit_lines(enabled=audit):
+            if bank_type == std_bank:
+                if master_descriptions is None:
+                    st.error("Please upload the master file for Standard Bank.")
+                elif uploaded_text_files:
+                    start_upload_job(name, convert_standard_bank_files, uploaded_text_files, master_descriptions,
+                                     chunksize=STANDARD_CHUNK_ROWS if stream_statement else None, **options)
+                else:
+                    st.error("Please upload the correct files before processing.")
+            elif bank_type == abs_bank:
+                if uploaded_text_files:
+                    # No need to check master file for ABSA
+                    start_upload_job(name, convert_bank_files, uploaded_text_files, 'absa', **options)
+                else:
+                    st.error("Please upload the correct files before processing.")
+            elif bank_type == cpt_bank:
+                if uploaded_text_files:
+                    # No need to check master file for CAPITEC
+                    start_upload_job(name, convert_bank_files, uploaded_text_files, 'capitec', **options)
+
+    show_jobs('banks', show_conversion)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
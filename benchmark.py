@@ -0,0 +1,180 @@
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from BANKS import (build_master_index, convert_absa_bank_file, convert_capitec_bank_file,
+                   convert_standard_bank_chunks, convert_standard_bank_frame, get_matching_codes,
+                   read_capitec_bank_file, read_master_file, read_standard_bank_file)
+from generate import EXCEL_MAX_ROWS, INPUT_KINDS, generate_inputs, parse_size
+from pages import AVBOB, BATCHES
+from transactions import format_transactions, frame_memory_mb
+from utils import OUTPUT_FORMATS, open_chunk_writers, to_format_bytes, to_format_sheets, write_chunks
+
+RESULT_COLUMNS = ['processor', 'rows', 'stage', 'seconds', 'rows_per_sec', 'peak_mb', 'frame_mb']
+
+
+# Run one stage and record how long it took and, in a second run, the most memory it
+# allocated. Stages must be repeatable, so they never change their inputs. When the stage
+# gives back a frame, the memory the frame holds is recorded too.
+def run_stage(results, processor, rows, stage, func, trace_memory=True):
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    results.append({'processor': processor, 'rows': rows, 'stage': stage, 'seconds': round(seconds, 4),
+                    'rows_per_sec': round(rows / seconds) if seconds else None,
+                    'peak_mb': round(peak_mb, 1) if peak_mb is not None else None,
+                    'frame_mb': round(frame_memory_mb(value), 2) if isinstance(value, pd.DataFrame) else None})
+    return value
+
+
+# Output formats to write, Excel only when the output fits in one sheet
+def output_formats(rows):
+    return [output_format for output_format in OUTPUT_FORMATS if output_format != 'xlsx' or rows <= EXCEL_MAX_ROWS]
+
+
+# Lay out the transactions of a bank as the converted file, then write it. The frame_mb
+# of the convert and format stages compares the compact frame with the written layout.
+def benchmark_format_and_writes(results, processor, rows, df, trace_memory):
+    df_formatted = run_stage(results, processor, rows, 'format', lambda: format_transactions(df), trace_memory)
+    benchmark_writes(results, processor, rows, df_formatted, trace_memory)
+
+
+# Write the converted frame in every output format
+def benchmark_writes(results, processor, rows, df, trace_memory):
+    for output_format in output_formats(rows):
+        run_stage(results, processor, rows, f"write {output_format}", lambda: to_format_bytes(df, output_format),
+                  trace_memory)
+
+
+def benchmark_standard(results, rows, paths, trace_memory):
+    master_descriptions = build_master_index(read_master_file(paths['master']))
+    df = run_stage(results, 'standard', rows, 'read', lambda: read_standard_bank_file(paths['standard']),
+                   trace_memory)
+    run_stage(results, 'standard', rows, 'match codes',
+              lambda: get_matching_codes(df[5].str.strip().str[6:]), trace_memory)
+    df_converted = run_stage(results, 'standard', rows, 'convert',
+                             lambda: convert_standard_bank_frame(df.copy(), master_descriptions), trace_memory)
+    benchmark_format_and_writes(results, 'standard', rows, df_converted, trace_memory)
+    for output_format in output_formats(rows):
+        run_stage(results, 'standard', rows, f"stream {output_format}",
+                  lambda: write_chunks(convert_standard_bank_chunks(paths['standard'], master_descriptions),
+                                       open_chunk_writers({output_format: io.BytesIO()})), trace_memory)
+
+
+def benchmark_absa(results, rows, paths, trace_memory):
+    # Reading is part of the conversion for ABSA statements
+    df_absa = run_stage(results, 'absa', rows, 'read + convert', lambda: convert_absa_bank_file(paths['absa']),
+                        trace_memory)
+    benchmark_format_and_writes(results, 'absa', rows, df_absa, trace_memory)
+
+
+def benchmark_capitec(results, rows, paths, trace_memory):
+    df = run_stage(results, 'capitec', rows, 'read', lambda: read_capitec_bank_file(paths['capitec']), trace_memory)
+    df_capitec = run_stage(results, 'capitec', rows, 'convert', lambda: convert_capitec_bank_file(df.copy()),
+                           trace_memory)
+    benchmark_format_and_writes(results, 'capitec', rows, df_capitec, trace_memory)
+
+
+def benchmark_batches(results, rows, paths, trace_memory):
+    with open(paths['batches'], 'rb') as f:
+        data = f.read()
+
+    # The page gets uploaded files, which have a name
+    def uploaded_file():
+        upload = io.BytesIO(data)
+        upload.name = os.path.basename(paths['batches'])
+        return upload
+
+    df = run_stage(results, 'batches', rows, 'read + convert', lambda: BATCHES.file_processor(uploaded_file()),
+                   trace_memory)
+    if df is not None:
+        benchmark_writes(results, 'batches', rows, df, trace_memory)
+
+
+def benchmark_avbob(results, rows, paths, trace_memory):
+    files = paths['avbob']
+    rows = min(rows, EXCEL_MAX_ROWS)
+    df_new_avbob, df_new_sheet, df_terminations = run_stage(
+        results, 'avbob', rows, 'read + convert',
+        lambda: AVBOB.process_employee_data(files['schedule'], files['new'], files['terminations']), trace_memory)
+    sheets = {'ACTIVE': df_new_avbob, 'NEW EMPLOYEES': df_new_sheet, 'TERMINATIONS': df_terminations}
+    for output_format in OUTPUT_FORMATS:
+        run_stage(results, 'avbob', rows, f"write {output_format}",
+                  lambda: to_format_sheets(sheets, output_format, 'final_output'), trace_memory)
+
+
+BENCHMARKS = {
+    'standard': benchmark_standard,
+    'absa': benchmark_absa,
+    'capitec': benchmark_capitec,
+    'batches': benchmark_batches,
+    'avbob': benchmark_avbob,
+}
+
+
+# Processor stages that got slower than the baseline by more than the tolerance
+def find_regressions(summary, baseline, tolerance):
+    compared = summary.merge(baseline, on=['processor', 'rows', 'stage'], suffixes=('', '_baseline'))
+    slower = compared['rows_per_sec'] < compared['rows_per_sec_baseline'] * (1 - tolerance)
+    return compared[slower]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure conversion throughput and memory on synthetic inputs.")
+    parser.add_argument("--rows", default="1k,10k,100k", help="comma separated sizes, e.g. 1k,100k,10M")
+    parser.add_argument("--processors", default=",".join(INPUT_KINDS), help="comma separated processors")
+    parser.add_argument("--input-dir", help="keep the generated inputs in this folder instead of a temporary one")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated inputs")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory runs")
+    parser.add_argument("--output", help="write the results to this CSV file")
+    parser.add_argument("--baseline", help="results CSV of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown against the baseline that counts as a regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    processors = [processor.strip() for processor in args.processors.split(",")]
+    unknown = set(processors) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown processors: {', '.join(sorted(unknown))}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_dir = args.input_dir or temp_dir
+        for size in args.rows.split(","):
+            rows = parse_size(size)
+            paths = generate_inputs(input_dir, rows, processors, args.seed)
+            for processor in processors:
+                BENCHMARKS[processor](results, rows, paths, not args.no_memory)
+
+    summary = pd.DataFrame(results, columns=RESULT_COLUMNS)
+    print(summary.to_string(index=False))
+    if args.output:
+        summary.to_csv(args.output, index=False)
+
+    if args.baseline:
+        regressions = find_regressions(summary, pd.read_csv(args.baseline), args.tolerance)
+        if not regressions.empty:
+            print(f"\n{len(regressions)} stages are more than {args.tolerance:.0%} slower than the baseline:")
+            print(regressions[['processor', 'rows', 'stage', 'rows_per_sec', 'rows_per_sec_baseline']]
+                  .to_string(index=False))
+            return 1
+        print(f"\nNo stage is more than {args.tolerance:.0%} slower than the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
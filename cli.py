@@ -0,0 +1,165 @@
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from BANKS import (build_master_index, convert_absa_bank_file, convert_capitec_bank_file,
+                   convert_standard_bank_chunks, convert_standard_bank_file, read_capitec_bank_file,
+                   read_master_file)
+from transactions import format_transactions
+from utils import (OUTPUT_FORMATS, audit_lines, audit_run_folder, open_chunk_writers, stage_source, to_format_bytes,
+                   write_chunks)
+
+BANK_TYPES = ['standard', 'absa', 'capitec']
+
+# Master file lookup, loaded once by the main process and handed to every worker when it starts
+master_descriptions = None
+
+
+def init_worker(shared_master_descriptions):
+    global master_descriptions
+    master_descriptions = shared_master_descriptions
+
+
+def convert_statement(bank_type, path):
+    if bank_type == 'standard':
+        return convert_standard_bank_file(path, master_descriptions)
+    if bank_type == 'absa':
+        return convert_absa_bank_file(path)
+    return convert_capitec_bank_file(read_capitec_bank_file(path))
+
+
+# Convert one statement in a worker process and report how it went. output_paths is a
+# dict of output format -> path. The matched and unmatched lines are written to the
+# audit run folder when it is given.
+def convert_and_save(bank_type, path, output_paths, chunksize=None, audit_run=None):
+    start = time.perf_counter()
+    try:
+        with stage_source(path), audit_lines(audit_run, enabled=audit_run is not None):
+            rows = convert_statement_to_files(bank_type, path, output_paths, chunksize)
+    except Exception as e:
+        # A statement that failed leaves no half written files behind
+        for output_path in output_paths.values():
+            with contextlib.suppress(OSError):
+                os.remove(output_path)
+        return {'file': path, 'output': '', 'status': 'failed', 'rows': 0,
+                'seconds': round(time.perf_counter() - start, 3), 'error': str(e)}
+
+    return {'file': path, 'output': ';'.join(output_paths.values()), 'status': 'ok', 'rows': rows,
+            'seconds': round(time.perf_counter() - start, 3), 'error': ''}
+
+
+def convert_statement_to_files(bank_type, path, output_paths, chunksize=None):
+    # Standard Bank statements can be streamed through in chunks of rows
+    if bank_type == 'standard' and chunksize:
+        return write_chunks(convert_standard_bank_chunks(path, master_descriptions, chunksize),
+                            open_chunk_writers(output_paths))
+
+    df = format_transactions(convert_statement(bank_type, path))
+    for output_format, output_path in output_paths.items():
+        with open(output_path, 'wb') as f:
+            f.write(to_format_bytes(df, output_format))
+    return len(df)
+
+
+# Expand directories and glob patterns into a list of statement files, in a stable order
+def find_statements(inputs):
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(os.path.join(pattern, name) for name in os.listdir(pattern)))
+        else:
+            paths.extend(sorted(glob.glob(pattern)))
+    return [path for path in dict.fromkeys(paths) if os.path.isfile(path)]
+
+
+# One output file per statement and format, numbered when two statements share a name
+def get_output_paths(paths, output_dir, output_formats=('xlsx',)):
+    output_paths = []
+    used = set()
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name = stem
+        number = 1
+        while name in used:
+            number += 1
+            name = f"{stem} ({number})"
+        used.add(name)
+        output_paths.append({output_format: os.path.join(output_dir, name + OUTPUT_FORMATS[output_format][0])
+                             for output_format in output_formats})
+    return output_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert bank statements without the Streamlit app.")
+    parser.add_argument("statements", nargs="+", help="statement files, directories or glob patterns")
+    parser.add_argument("--bank", required=True, choices=BANK_TYPES, help="bank the statements come from")
+    parser.add_argument("--master", help="master file (Excel), required for Standard Bank")
+    parser.add_argument("--output-dir", default=os.path.join("temp", "converted"),
+                        help="folder for the converted files and the run summary")
+    parser.add_argument("--chunksize", type=int,
+                        help="stream Standard Bank statements through this many rows at a time")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--formats", default="xlsx",
+                        help=f"comma separated output formats out of {', '.join(OUTPUT_FORMATS)} (default xlsx)")
+    parser.add_argument("--audit-dir",
+                        help="write the lines that got a code and the lines that didn't to a new folder for "
+                             "the run in this folder, a folder per statement")
+    args = parser.parse_args(argv)
+
+    output_formats = [output_format.strip() for output_format in args.formats.split(",")]
+    unknown = set(output_formats) - set(OUTPUT_FORMATS)
+    if unknown:
+        parser.error(f"unknown output formats: {', '.join(sorted(unknown))}")
+
+    if args.bank == 'standard' and not args.master:
+        parser.error("--master is required for Standard Bank statements")
+
+    paths = find_statements(args.statements)
+    if not paths:
+        parser.error("no statements found")
+
+    shared_master_descriptions = None
+    if args.master:
+        shared_master_descriptions = build_master_index(read_master_file(args.master))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_paths = get_output_paths(paths, args.output_dir, output_formats)
+
+    # All statements of the run are audited in the same run folder
+    audit_run = audit_run_folder(args.audit_dir) if args.audit_dir else None
+
+    start = time.perf_counter()
+    results = []
+    workers = max(1, min(args.workers, len(paths)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(shared_master_descriptions,)) as pool:
+        futures = [pool.submit(convert_and_save, args.bank, path, output_path, args.chunksize, audit_run)
+                   for path, output_path in zip(paths, output_paths)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'ok':
+                print(f"{result['file']}: {result['rows']} rows -> {result['output']} ({result['seconds']}s)")
+            else:
+                print(f"{result['file']}: failed: {result['error']}", file=sys.stderr)
+
+    # Run summary in the same order as the statements were given
+    summary = pd.DataFrame(results, columns=['file', 'output', 'status', 'rows', 'seconds', 'error'])
+    summary = summary.set_index('file').loc[paths].reset_index()
+    summary_path = os.path.join(args.output_dir, "summary.csv")
+    summary.to_csv(summary_path, index=False)
+
+    failed = (summary['status'] != 'ok').sum()
+    print(f"Converted {len(paths) - failed} of {len(paths)} statements with {workers} workers "
+          f"in {time.perf_counter() - start:.2f}s, summary written to {summary_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from utils import write_excel_chunks
+
+# Rows generated at a time, so even the largest inputs are never in memory all at once
+GENERATE_BLOCK_ROWS = 100_000
+
+# Rows an Excel sheet can hold below its header, AVBOB inputs are capped at this
+EXCEL_MAX_ROWS = 1_048_575
+
+INPUT_KINDS = ['standard', 'absa', 'capitec', 'batches', 'avbob']
+
+LETTERS = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+DIGITS = np.array(list('0123456789'))
+
+# Shape of the codes of every Standard Bank and ABSA pattern, N is a number and L a letter
+CODE_SHAPES = {
+    'pattern6': 'NNLLLNNNN',
+    'pattern2': 'NNLLLLNNN',
+    'pattern1': 'NNLLLNNN',
+    'pattern7': 'LLLNNNN',
+    'pattern8': 'LLLNNN',
+    'pattern3': 'NLLNNN',
+    'pattern4': 'NLLLNNN',
+    'pattern5': 'LLNNNN',
+    'pattern9': 'NLLLLNN',
+    'pattern10': 'NLLLL',
+    'pattern11': 'LLLLNN',
+    'pattern14': 'NLLLLNNNN',
+}
+
+# Share of statement lines of every kind: a code from the master file, a DIV line, a code
+# rejected because it is followed by ':' and a line without a code
+LINE_KINDS = ['code', 'div', 'colon', 'none']
+LINE_KIND_SHARES = [0.75, 0.05, 0.05, 0.15]
+
+NAMES = ['BATHO', 'JANKEN', 'JH LAU', 'RED AL', 'CHAUKE', 'CUMAX', 'FARLOW', 'NGOMSO', 'RIBYE', 'MME BA',
+         'FABERTEC', 'SANLAM', 'MOMENTUM', 'WINDEED', 'PIONEER', 'CASHFOCUS', 'SASOL', 'VAN WYK']
+FILLERS = ['SBSA VAF  40202909 0118 15 JAN', 'PIONEER 22221566916', 'CASHFOCUS 380000 RWC ABSA',
+           'SEESA     LABOUR 65486', 'OPEN BALANCE ADJUSTMENT', 'SERVICE FEE', 'INTEREST CAPITALISED']
+ABSA_PREFIXES = ['ACB DEBIT:EXTERNAL', 'ACB DEBIT:EXTERNALSL-DEBITS ', 'ACB CREDIT ', 'DEBIT TRANSFER',
+                 'DEBIT TRANSFER204455 ', '']
+
+
+# Parse sizes such as 1000, 10k or 1M
+def parse_size(size):
+    size = size.strip().lower()
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(size[-1:], 1)
+    return int(float(size.rstrip('km')) * multiplier)
+
+
+def random_code(rng, shape):
+    return ''.join(rng.choice(LETTERS) if kind == 'L' else rng.choice(DIGITS) for kind in shape)
+
+
+# A pool of unique codes, spread evenly over the code patterns
+def make_code_pool(rng, count):
+    codes = {}
+    shapes = list(CODE_SHAPES.values())
+    while len(codes) < count:
+        codes[random_code(rng, shapes[len(codes) % len(shapes)])] = None
+    return list(codes)
+
+
+# Master file for Standard Bank: most of the pool codes with a description each
+def generate_master_file(path, codes, rng):
+    known = [code for code in codes if rng.random() < 0.9]
+    descriptions = [f"{rng.choice(NAMES)} {index}" for index in range(len(known))]
+    pd.DataFrame({'CODE1': known, 'DESCRIPTION': descriptions}).to_excel(path, index=False)
+    return path
+
+
+def random_dates(rng, rows):
+    days = np.datetime64('2024-01-01') + rng.integers(0, 366, rows)
+    return pd.DatetimeIndex(days)
+
+
+def random_amounts(rng, rows, debit_share=0.8):
+    amounts = np.round(rng.lognormal(7, 1.5, rows), 2)
+    return np.where(rng.random(rows) < debit_share, -amounts, amounts)
+
+
+# Descriptions of Standard Bank style lines, every line starts with 6 characters that are
+# not part of the code
+def random_descriptions(rng, rows, codes):
+    kinds = rng.choice(LINE_KINDS, rows, p=LINE_KIND_SHARES)
+    picked = rng.choice(codes, rows)
+    names = rng.choice(NAMES, rows)
+    fillers = rng.choice(FILLERS, rows)
+    refs = rng.integers(10, 60, rows)
+
+    descriptions = []
+    for kind, code, name, filler, ref in zip(kinds, picked, names, fillers, refs):
+        if kind == 'code':
+            descriptions.append(f"{code[:5]:<5} {code} {name[:6]} NHU2312:{ref}")
+        elif kind == 'div':
+            descriptions.append(f"{code[:5]:<5} {code}0 DIV{ref} NHU2312:{ref}")
+        elif kind == 'colon':
+            descriptions.append(f"{code[:5]:<5} {code}:{ref} {name[:6]}")
+        else:
+            descriptions.append(f"      {filler}")
+    return descriptions
+
+
+def generate_standard_bank(path, rows, codes, rng):
+    with open(path, 'w', newline='') as f:
+        f.write('"ALL ",000005534,"BRANCH", 0000000000000.00,"                              ",'
+                '"BRANDWAG                              ",000000,000.00\n')
+        f.write('"    ",370223659,"ACC-NO", 0000000000000.00,"                              ",'
+                '"RUWACON PTY LTD                       ",000000,000.00\n')
+        f.write('"0943",020240101,"OPEN  ",+0000019032106.67,"                              ",'
+                '"OPEN BALANCE                          ",000000,000.00\n')
+
+        for start in range(0, rows, GENERATE_BLOCK_ROWS):
+            block = min(GENERATE_BLOCK_ROWS, rows - start)
+            dates = random_dates(rng, block).strftime('%Y%m%d')
+            amounts = random_amounts(rng, block)
+            descriptions = random_descriptions(rng, block, codes)
+            types = rng.choice(['PAY   ', 'ACB   ', 'TRFR  '], block, p=[0.8, 0.15, 0.05])
+            f.writelines(
+                f'"0943",0{date},"{kind}",{amount:+017.2f},"{"ELECTRONIC BANKING PAYMENT TO":<30}",'
+                f'"{description[:38]:<38}",000509,000.00\n'
+                for date, kind, amount, description in zip(dates, types, amounts, descriptions)
+            )
+
+        f.write('"0943",020241231,"CLOSE ",+0000000999273.13,"                              ",'
+                '"CLOSE BALANCE                         ",000000,000.00\n')
+    return path
+
+
+def generate_absa(path, rows, codes, rng):
+    balance = 19146746.80
+    with open(path, 'w', newline='') as f:
+        f.write(f"4058510443,334134,240101,00,BALANCE B/FORWARD, ,0.00,{balance:.2f}\n")
+
+        for start in range(0, rows, GENERATE_BLOCK_ROWS):
+            block = min(GENERATE_BLOCK_ROWS, rows - start)
+            dates = random_dates(rng, block).strftime('%y%m%d')
+            amounts = random_amounts(rng, block)
+            balances = balance + np.cumsum(amounts)
+            balance = balances[-1]
+            prefixes = rng.choice(ABSA_PREFIXES, block)
+            # ABSA codes may be anywhere in the line, so the 6 leading characters are dropped
+            descriptions = [description[6:].strip() or 'SERVICE FEE'
+                            for description in random_descriptions(rng, block, codes)]
+            f.writelines(
+                f"4058510443,334134,{date},{start + index + 1},{prefix}{description},SETTLEMENT,"
+                f"{amount:.2f},{running:.2f}\n"
+                for index, (date, prefix, description, amount, running)
+                in enumerate(zip(dates, prefixes, descriptions, amounts, balances))
+            )
+    return path
+
+
+def generate_capitec(path, rows, rng):
+    balance = 1332700.33
+    with open(path, 'w', newline='') as f:
+        f.write(f"Balance brought forward:,{balance}\n\n")
+        f.write("Account,Date,Description,Reference,Amount,Fees,Balance,\n")
+
+        total = 0.0
+        for start in range(0, rows, GENERATE_BLOCK_ROWS):
+            block = min(GENERATE_BLOCK_ROWS, rows - start)
+            dates = random_dates(rng, block).strftime('%d/%m/%Y')
+            amounts = random_amounts(rng, block)
+            balances = balance + np.cumsum(amounts)
+            balance = balances[-1]
+            total += amounts.sum()
+            sites = rng.integers(100, 1000, block)
+            activities = rng.choice(['B', 'C', 'A'], block)
+            lines = []
+            for date, amount, running, site, activity in zip(dates, amounts, balances, sites, activities):
+                if amount < 0:
+                    lines.append(f'1051181240,{date},"STP/Batch Payment",{f"D{site} {activity} 31DES":<50},'
+                                 f'{amount:.2f},,{running:.2f}\n')
+                else:
+                    lines.append(f'1051181240,{date},"Cr Trf",{f"ACCOUNT CLOSED {site} From 2206524109":<50},'
+                                 f'{amount:.2f},,{running:.2f}\n')
+            f.writelines(lines)
+
+        # The monthly fee and the total line close every statement
+        f.write(f'1051181240,31/12/2024,"Month S/Fee",{"":<50},,-50.00,{balance - 50:.2f}\n')
+        f.write(f"Total:,,,,{total},-50.0,{balance - 50:.2f}")
+    return path
+
+
+def generate_batches(path, rows, rng):
+    with open(path, 'w', newline='', encoding='ISO-8859-1') as f:
+        f.write("SB;20250115;RWC 15JAN25                   ;25-01-15;        ;        ;        ;        ;"
+                "        ;        ;        ;        ;16:06:;00:00:;00:00:;00:00:;00:00:;00:00:;00:00:;"
+                "00:00:;00:00:;ZCX83\n")
+
+        total = 0
+        for start in range(0, rows, GENERATE_BLOCK_ROWS):
+            block = min(GENERATE_BLOCK_ROWS, rows - start)
+            employees = rng.integers(100000, 999999, block)
+            accounts = rng.integers(10 ** 9, 10 ** 12, block)
+            branches = rng.integers(100000, 999999, block)
+            names = rng.choice(NAMES, block)
+            amounts = rng.integers(10000, 10 ** 8, block)
+            total += int(amounts.sum())
+            f.writelines(
+                f"SD;{employee:<18};{account:013d};{branch};001;{f'{employee} {name}':<30};C;{amount:015d};"
+                f"0000000000;C4;FINAL AUDIT TO BE DOWNLOA;{'RUWACON PTY LTD':<30};0000370223659;055534;001;"
+                f"{(start + index + 1) % 100000:05d};2025015002;RWC 15JAN25\n"
+                for index, (employee, account, branch, name, amount)
+                in enumerate(zip(employees, accounts, branches, names, amounts))
+            )
+
+        f.write(f"SC;001;00000;D;0000370223659;055534;000;{'RUWACON PTY LTD':<30};{total:015d};"
+                f"{'RWC 15JAN25':<30};C4;FINAL AUDIT TO BE DOWNLOA\n")
+        f.write(f"ST;0000000;{rows:07d}\n")
+    return path
+
+
+AVBOB_COLUMNS = ['MEMBER NR', 'PLAN', 'PREMIUM', 'ACTION TYPE', 'COMM DATE', 'PERSON TYPE', 'SURNAME',
+                 'INITIALS', 'DOB', 'ID NUMBER', 'LANGUAGE', 'GENDER', 'SUM ASS', 'POSTAL ADDRESS LINE 1',
+                 'POSTAL  ADDRESS LINE 2', 'POSTAL  ADDRESS LINE 3', 'POSTAL CODE', 'RES ADDRESS LINE 1',
+                 'RES ADDRESS LINE 2', 'RES ADDRESS LINE 3', 'POSTAL CODE.1', 'WORK TELEPHONE NUMBER',
+                 'HOME TELEPHONE NUMBER', 'CELLULAR NUMBER', 'EMAIL ADDRESS', 'BENEF SURNAME', 'BENEF INITALS',
+                 'BENEF ID NUMBER']
+NEW_EMPLOYEE_COLUMNS = ['Employee Code', 'Surname', 'Initials', 'ID Number', 'Date of Birth', 'Passport',
+                        'Group', 'Gender', 'Date Engaged']
+TERMINATION_COLUMNS = NEW_EMPLOYEE_COLUMNS + ['Date Terminated']
+
+
+def random_people(rng, rows, first_code):
+    births = random_dates(rng, rows) - pd.to_timedelta(rng.integers(18 * 365, 60 * 365, rows), unit='D')
+    births = births.strftime('%Y%m%d')
+    ids = [f"{birth[2:]}{number:07d}" for birth, number in zip(births, rng.integers(0, 10 ** 7, rows))]
+    return pd.DataFrame({
+        'code': np.arange(first_code, first_code + rows).astype(str),
+        'surname': rng.choice(NAMES, rows),
+        'initials': [''.join(rng.choice(LETTERS, 2)) for _ in range(rows)],
+        'id': ids,
+        'birth': births,
+        'gender': rng.choice(['M', 'F'], rows),
+        'group': rng.choice(['A', 'B', 'C'], rows),
+    })
+
+
+# The previous month's schedule, new employees and terminations, terminating some of the
+# scheduled employees
+def generate_avbob(output_dir, rows, rng, name='avbob'):
+    rows = min(rows, EXCEL_MAX_ROWS)
+    changes = max(1, rows // 10)
+
+    people = random_people(rng, rows, 1000)
+    schedule = pd.DataFrame('', index=range(rows), columns=AVBOB_COLUMNS)
+    schedule['MEMBER NR'] = people['code']
+    schedule['PLAN'] = 'A'
+    schedule['PREMIUM'] = '1284'
+    schedule['ACTION TYPE'] = people['group']
+    schedule['COMM DATE'] = '202401'
+    schedule['PERSON TYPE'] = '1'
+    schedule['SURNAME'] = people['surname']
+    schedule['INITIALS'] = people['initials']
+    schedule['DOB'] = people['birth']
+    schedule['ID NUMBER'] = people['id']
+    schedule['LANGUAGE'] = 'E'
+    schedule['GENDER'] = people['gender']
+
+    new_people = random_people(rng, changes, 1000 + rows)
+    # Some new employees only have a passport number
+    ids = np.where(rng.random(changes) < 0.1, '', new_people['id'])
+    new_employees = pd.DataFrame(dict(zip(NEW_EMPLOYEE_COLUMNS, [
+        new_people['code'], new_people['surname'], new_people['initials'], ids, new_people['birth'],
+        [f"RC{number:06d}" for number in rng.integers(0, 10 ** 6, changes)], new_people['group'],
+        new_people['gender'], '20241202',
+    ])))
+    new_employees['ID Number'] = new_employees['ID Number'].replace('', None)
+
+    leaving = people.sample(n=min(changes, rows), random_state=int(rng.integers(2 ** 31)))
+    terminations = pd.DataFrame(dict(zip(TERMINATION_COLUMNS, [
+        leaving['code'], leaving['surname'], leaving['initials'], leaving['id'], leaving['birth'], '',
+        leaving['group'], leaving['gender'], '20240411', '20241129',
+    ])))
+
+    paths = {}
+    for kind, df in [('schedule', schedule), ('new', new_employees), ('terminations', terminations)]:
+        paths[kind] = os.path.join(output_dir, f"{name}_{kind}.xlsx")
+        write_excel_chunks([df], paths[kind])
+    return paths
+
+
+# Generate every kind of input for one size. Returns a dict of kind -> path, the AVBOB
+# entry is a dict with the schedule, new employee and termination files.
+def generate_inputs(output_dir, rows, kinds=INPUT_KINDS, seed=0, master_codes=5000):
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    codes = make_code_pool(rng, master_codes)
+
+    paths = {}
+    if 'standard' in kinds:
+        paths['master'] = generate_master_file(os.path.join(output_dir, "master.xlsx"), codes, rng)
+        paths['standard'] = generate_standard_bank(os.path.join(output_dir, f"standard_{rows}.txt"), rows, codes, rng)
+    if 'absa' in kinds:
+        paths['absa'] = generate_absa(os.path.join(output_dir, f"absa_{rows}.csv"), rows, codes, rng)
+    if 'capitec' in kinds:
+        paths['capitec'] = generate_capitec(os.path.join(output_dir, f"capitec_{rows}.csv"), rows, rng)
+    if 'batches' in kinds:
+        paths['batches'] = generate_batches(os.path.join(output_dir, f"batches_{rows}.txt"), rows, rng)
+    if 'avbob' in kinds:
+        paths['avbob'] = generate_avbob(output_dir, rows, rng, name=f"avbob_{rows}")
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic statements, batches and AVBOB schedules.")
+    parser.add_argument("--rows", default="1k", help="comma separated sizes, e.g. 1k,100k,10M")
+    parser.add_argument("--kinds", default=",".join(INPUT_KINDS), help="comma separated input kinds")
+    parser.add_argument("--output-dir", default=os.path.join("temp", "generated"), help="folder for the inputs")
+    parser.add_argument("--master-codes", type=int, default=5000, help="number of codes in the master file")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed gives the same files")
+    args = parser.parse_args(argv)
+
+    kinds = [kind.strip() for kind in args.kinds.split(",")]
+    unknown = set(kinds) - set(INPUT_KINDS)
+    if unknown:
+        parser.error(f"unknown input kinds: {', '.join(sorted(unknown))}")
+
+    for size in args.rows.split(","):
+        rows = parse_size(size)
+        paths = generate_inputs(args.output_dir, rows, kinds, args.seed, args.master_codes)
+        for kind, path in paths.items():
+            print(f"{kind} ({rows} rows): {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,129 +1,234 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
+import glob
+import hashlib
+import importlib.util
 import logging
+import os
+import time
+from utils import (download, job_file, record_stages, save_output_copy, select_output_formats, show_conversion,
+                   show_jobs, stage, stages_enabled, start_job, to_format_sheets)
 
 # Set up logging
 logging.basicConfig(level=logging.ERROR)
 
-def process_employee_data(avbob_file, new_file, terminate_file):
+# Excel backend the workbooks are read with. calamine reads faster, but hasn't been
+# compared with openpyxl on these files yet, so it is only used when picked on the page.
+EXCEL_ENGINE = "openpyxl"
+CALAMINE_INSTALLED = importlib.util.find_spec("python_calamine") is not None
+
+# Every generated ACTIVE schedule is kept here as a Parquet snapshot, so next month's run
+# can start from it instead of reading the schedule workbook again
+SCHEDULE_SNAPSHOT_DIR = os.path.join("temp", "avbob")
+
+# Schedule columns that come from the previous schedule and the new employees, position
+# in the schedule -> position in the new employee file
+SCHEDULE_NEW_EMPLOYEE_COLUMNS = {
+    0: 0,   # Employee codes
+    3: 6,   # Groups
+    4: 8,   # Commencement date
+    6: 1,   # Surnames
+    7: 2,   # Initials
+    8: 4,   # Date of birth
+    9: 3,   # ID
+    11: 7,  # Gender
+}
+
+# Values of the schedule columns that are the same for every employee, by position
+SCHEDULE_DEFAULTS = {
+    1: "A",
+    2: 1284,
+    5: 1,
+    10: "E",
+    12: 2000000,
+    13: "PO BOX 13596",
+    14: "NOORDSTAD",
+    15: "BLOEMFONTEIN",
+    16: 9302,
+    21: 514030400,
+}
+
+# Column names in the header row of a workbook, without parsing the rows below it
+def read_workbook_header(file, engine=EXCEL_ENGINE):
+    columns = pd.read_excel(file, engine=engine, dtype=str, nrows=0).columns
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return columns
+
+
+# Every cell as text, only the columns at the usecols positions when given
+def read_workbook(file, usecols=None, engine=EXCEL_ENGINE):
+    return pd.read_excel(file, engine=engine, dtype=str, usecols=usecols)
+
+
+# The previous schedule can be the uploaded workbook or a snapshot loaded with
+# load_schedule_snapshot
+def process_employee_data(avbob_file, new_file, terminate_file, engine=EXCEL_ENGINE):
     try:
-        # Read AVBOB data
-        df_avbob = pd.read_excel(avbob_file, engine="openpyxl", dtype=str)
-        df_avbob.columns = df_avbob.columns.str.strip()
-        avbob_columns = df_avbob.columns
-
-        # Read New Employee data
-        df_new_employees = pd.read_excel(new_file, engine="openpyxl", dtype=str)
-        df_new_employees.columns = df_new_employees.columns.str.strip()
-        add_columns = df_new_employees.columns
-        if len(add_columns) != 9:
-            raise ValueError(f"The new employee data file only has {len(add_columns)} columns, it should have 9.")
-
-        # Read Terminations data
-        df_terminations = pd.read_excel(terminate_file, engine="openpyxl", dtype=str)
-        terminations_columns = df_terminations.columns
-        if len(terminations_columns) != 10:
-            raise ValueError(f"The termination data file only has {len(terminations_columns)} columns, it should have 10.")
+        with stage("read") as record:
+            # Check the header rows first, so files with the wrong number of columns fail
+            # before the schedule is parsed
+            add_columns = read_workbook_header(new_file, engine)
+            if len(add_columns) != 9:
+                raise ValueError(f"The new employee data file only has {len(add_columns)} columns, it should have 9.")
+            terminations_columns = read_workbook_header(terminate_file, engine)
+            if len(terminations_columns) != 10:
+                raise ValueError(f"The termination data file only has {len(terminations_columns)} columns, it should have 10.")
 
-#======================================================================================================================
-# CONSTRUCTION OF NEW AVBOB SCHEDULE
-#======================================================================================================================
+            # Read AVBOB data, only the columns that are taken over into the new schedule
+            if isinstance(avbob_file, pd.DataFrame):
+                df_avbob = avbob_file.copy()
+                avbob_columns = df_avbob.columns
+            else:
+                avbob_columns = read_workbook_header(avbob_file, engine)
+                schedule_width = max(*SCHEDULE_NEW_EMPLOYEE_COLUMNS, *SCHEDULE_DEFAULTS) + 1
+                if len(avbob_columns) < schedule_width:
+                    raise ValueError(f"The previous schedule only has {len(avbob_columns)} columns, "
+                                     f"it should have at least {schedule_width}.")
+                df_avbob = read_workbook(avbob_file, list(SCHEDULE_NEW_EMPLOYEE_COLUMNS), engine)
+            df_avbob.columns = df_avbob.columns.str.strip()
+            avbob_columns = avbob_columns.str.strip()
 
-        # Initialize the new dataframe
-        df_new_avbob = pd.DataFrame(columns=avbob_columns)
+            # Read New Employee data
+            df_new_employees = read_workbook(new_file, engine=engine)
+            df_new_employees.columns = df_new_employees.columns.str.strip()
+            add_columns = df_new_employees.columns
+            # A stray cell right of the header row makes the sheet wider than its header
+            if len(add_columns) != 9:
+                raise ValueError(f"The new employee data file only has {len(add_columns)} columns, it should have 9.")
 
-        # Employee Codes
-        og_employees = pd.Series(df_avbob[avbob_columns[0]])
-        new_employees = pd.Series(df_new_employees[add_columns[0]])
-        combined_employees = pd.concat([og_employees.reset_index(drop=True), new_employees.reset_index(drop=True)], axis=0)  # Reset indices before concatenating
+            # Read Terminations data
+            df_terminations = read_workbook(terminate_file, engine=engine)
+            terminations_columns = df_terminations.columns
+            if len(terminations_columns) != 10:
+                raise ValueError(f"The termination data file only has {len(terminations_columns)} columns, it should have 10.")
+            record['rows'] = len(df_avbob) + len(df_new_employees) + len(df_terminations)
 
-        # Groups
-        og_group = pd.Series(df_avbob[avbob_columns[3]])
-        new_group = pd.Series(df_new_employees[add_columns[6]])
-        combined_group = pd.concat([og_group.reset_index(drop=True), new_group.reset_index(drop=True)], axis=0)
+#======================================================================================================================
+# CONSTRUCTION OF NEW AVBOB SCHEDULE
+#======================================================================================================================
 
-        # ID
-        og_id = pd.Series(df_avbob[avbob_columns[9]])
-        df_new_employees[add_columns[3]] = df_new_employees[add_columns[3]].fillna(df_new_employees[add_columns[5]])
-        new_id = pd.Series(df_new_employees[add_columns[3]].astype(str))
-        combined_id = pd.concat([og_id.reset_index(drop=True), new_id.reset_index(drop=True)], axis=0)
+        with stage("build schedule") as record:
+            # ID, the passport number when there is none
+            df_new_employees[add_columns[3]] = df_new_employees[add_columns[3]].fillna(df_new_employees[add_columns[5]])
+            df_new_employees[add_columns[3]] = df_new_employees[add_columns[3]].astype(str)
 
     #==================================
     # NEW EMPLOYEE SHEET
     #==================================
-        df_new_employees[add_columns[3]] = new_id
-        df_new_sheet = df_new_employees.copy()
-        df_new_sheet.drop(columns=[add_columns[5], add_columns[6] ], inplace=True)
-
-        # Commencement date
-        df_new_employees[add_columns[8]] = df_new_employees[add_columns[8]].astype(str).str[:-2].astype(int)
-        og_commence = pd.Series(df_avbob[avbob_columns[4]])
-        new_commence = pd.Series(df_new_employees[add_columns[8]])
-        combined_commence = pd.concat([og_commence.reset_index(drop=True), new_commence.reset_index(drop=True)], axis=0)
-
-        # Surnames
-        og_surnames = pd.Series(df_avbob[avbob_columns[6]])
-        new_surnames = pd.Series(df_new_employees[add_columns[1]])
-        combined_surnames = pd.concat([og_surnames.reset_index(drop=True), new_surnames.reset_index(drop=True)], axis=0)
-
-        # Initials
-        og_initials = pd.Series(df_avbob[avbob_columns[7]])
-        new_initials = pd.Series(df_new_employees[add_columns[2]])
-        combined_initials = pd.concat([og_initials.reset_index(drop=True), new_initials.reset_index(drop=True)], axis=0)
-
-        # Date of birth
-        og_birth = pd.Series(df_avbob[avbob_columns[8]])
-        new_birth = pd.Series(df_new_employees[add_columns[4]])
-        combined_birth = pd.concat([og_birth.reset_index(drop=True), new_birth.reset_index(drop=True)], axis=0)
-
-        # Gender
-        og_gender = pd.Series(df_avbob[avbob_columns[11]])
-        new_gender = pd.Series(df_new_employees[add_columns[7]])
-        combined_gender = pd.concat([og_gender.reset_index(drop=True), new_gender.reset_index(drop=True)], axis=0)
-
-        # Reconstruct the new avbob datadrame
-        df_new_avbob[avbob_columns[0]] = pd.Series(combined_employees.values)
-        df_new_avbob[avbob_columns[1]] = df_new_avbob[avbob_columns[1]].fillna("A")
-        df_new_avbob[avbob_columns[2]] = df_new_avbob[avbob_columns[2]].fillna(1284)
-        df_new_avbob[avbob_columns[3]] = pd.Series(combined_group.values)
-        df_new_avbob[avbob_columns[4]] = pd.Series(combined_commence.values)
-        df_new_avbob[avbob_columns[5]] = df_new_avbob[avbob_columns[5]].fillna(1)
-        df_new_avbob[avbob_columns[6]] = pd.Series(combined_surnames.values)
-        df_new_avbob[avbob_columns[7]] = pd.Series(combined_initials.values)
-        df_new_avbob[avbob_columns[8]] = pd.Series(combined_birth.values)
-        df_new_avbob[avbob_columns[9]] = pd.Series(combined_id.values)
-        df_new_avbob[avbob_columns[10]] = df_new_avbob[avbob_columns[10]].fillna("E")
-        df_new_avbob[avbob_columns[11]] = pd.Series(combined_gender.values)
-        df_new_avbob[avbob_columns[12]] = df_new_avbob[avbob_columns[12]].fillna(2000000)
-        df_new_avbob[avbob_columns[13]] = df_new_avbob[avbob_columns[13]].fillna("PO BOX 13596")
-        df_new_avbob[avbob_columns[14]] = df_new_avbob[avbob_columns[14]].fillna("NOORDSTAD")
-        df_new_avbob[avbob_columns[15]] = df_new_avbob[avbob_columns[15]].fillna("BLOEMFONTEIN")
-        df_new_avbob[avbob_columns[16]] = df_new_avbob[avbob_columns[16]].fillna(9302)
-        df_new_avbob[avbob_columns[21]] = df_new_avbob[avbob_columns[21]].fillna(514030400)
-
-        # Remove terminations from completed list
-        valid_terminations = df_terminations[terminations_columns[0]].dropna().unique()
-        df_new_avbob[avbob_columns[0]] = df_new_avbob[avbob_columns[0]].astype(str)
-        valid_terminations = valid_terminations.astype(str)
-        df_new_avbob[avbob_columns[0]] = df_new_avbob[avbob_columns[0]].str.strip()
-        valid_terminations = [code.strip() for code in valid_terminations]
-        df_new_avbob = df_new_avbob[~df_new_avbob[avbob_columns[0]].isin(valid_terminations)]
+            df_new_sheet = df_new_employees.copy()
+            df_new_sheet.drop(columns=[add_columns[5], add_columns[6] ], inplace=True)
+
+            # Commencement date
+            df_new_employees[add_columns[8]] = df_new_employees[add_columns[8]].astype(str).str[:-2].astype(int)
+
+            # The previous schedule with the new employees added below it, in one block
+            schedule_columns = [avbob_columns[position] for position in SCHEDULE_NEW_EMPLOYEE_COLUMNS]
+            new_employees = df_new_employees.iloc[:, list(SCHEDULE_NEW_EMPLOYEE_COLUMNS.values())]
+            new_employees = new_employees.set_axis(schedule_columns, axis=1)
+            # An empty block doesn't decide the column types, the same as when every column
+            # was concatenated on its own
+            blocks = [df_avbob[schedule_columns], new_employees]
+            combined = pd.concat([block for block in blocks if len(block)] or blocks[:1], ignore_index=True)
+
+            # Reconstruct the new avbob datadrame, the other columns are empty apart from the defaults
+            df_new_avbob = combined.reindex(columns=avbob_columns).astype(
+                {column: object for column in avbob_columns if column not in schedule_columns})
+            df_new_avbob = df_new_avbob.assign(**{avbob_columns[position]: value
+                                                  for position, value in SCHEDULE_DEFAULTS.items()})
+
+            # A new employee already on the schedule would be added twice, usually because the
+            # schedule is one that already has this month's new employees
+            previous_codes = df_avbob[avbob_columns[0]].dropna().astype(str).str.strip()
+            new_codes = df_new_employees[add_columns[0]].dropna().astype(str).str.strip()
+            duplicates = new_codes[new_codes.isin(previous_codes)].drop_duplicates()
+            if len(duplicates):
+                raise ValueError(f"{len(duplicates):,} new employee codes are already on the previous schedule "
+                                 f"({', '.join(duplicates[:5])}{', ...' if len(duplicates) > 5 else ''}). "
+                                 f"Check that the previous month's schedule is the right one.")
+
+            # Remove terminations from completed list
+            member_codes = df_new_avbob[avbob_columns[0]].astype(str).str.strip()
+            df_new_avbob[avbob_columns[0]] = member_codes
+            valid_terminations = df_terminations[terminations_columns[0]].dropna().astype(str).str.strip()
+            df_new_avbob = df_new_avbob[~member_codes.isin(valid_terminations)]
+
+            # How the schedule changed since last month
+            df_new_avbob.attrs['delta'] = {
+                'previous': len(df_avbob),
+                'added': len(df_new_employees),
+                'terminated': len(combined) - len(df_new_avbob),
+                'unmatched terminations': int((~valid_terminations.drop_duplicates().isin(member_codes)).sum()),
+            }
 
     #==================================
     # TERMINATIONS SHEET
     #==================================
-        df_terminations[terminations_columns[3]] = df_terminations[terminations_columns[3]].fillna(df_terminations[terminations_columns[5]])
-        new_terminations_id = pd.Series(df_terminations[terminations_columns[3]].astype(str))
-        df_terminations[terminations_columns[3]] = new_terminations_id
-        term_passport = terminations_columns[5]
-        term_group = terminations_columns[6]
-        df_terminations.drop(columns = [term_passport, term_group], inplace=True)
+            df_terminations[terminations_columns[3]] = df_terminations[terminations_columns[3]].fillna(df_terminations[terminations_columns[5]])
+            new_terminations_id = pd.Series(df_terminations[terminations_columns[3]].astype(str))
+            df_terminations[terminations_columns[3]] = new_terminations_id
+            term_passport = terminations_columns[5]
+            term_group = terminations_columns[6]
+            df_terminations.drop(columns = [term_passport, term_group], inplace=True)
+            record['rows'] = len(df_new_avbob)
 
 
         return df_new_avbob, df_new_sheet, df_terminations
     except Exception as e:
             logging.error(f"Error processing employee data: {e}")
             raise
+# The schedule as it is read back from the downloaded workbook, every cell as text and
+# empty cells as NaN
+def schedule_snapshot_frame(df_schedule):
+    return df_schedule.astype(object).map(lambda value: np.nan if pd.isna(value) or value == '' else str(value))
+
+
+# Keep a snapshot of a generated schedule, keyed by member code. Snapshots are named after
+# when they were taken and a hash of their contents, so the same schedule is only kept
+# once. Returns the path of the snapshot.
+def save_schedule_snapshot(df_schedule):
+    snapshot = schedule_snapshot_frame(df_schedule).reset_index(drop=True)
+    digest = hashlib.sha256(pd.util.hash_pandas_object(snapshot, index=False).to_numpy().tobytes())
+    digest.update('\0'.join(snapshot.columns).encode())
+    content_hash = digest.hexdigest()[:16]
+    existing = glob.glob(os.path.join(SCHEDULE_SNAPSHOT_DIR, f"* {content_hash}.parquet"))
+    if existing:
+        return existing[0]
+
+    os.makedirs(SCHEDULE_SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SCHEDULE_SNAPSHOT_DIR, f"{time.strftime('%Y-%m-%d %H%M%S')} {content_hash}.parquet")
+    snapshot.set_index(snapshot.columns[0]).to_parquet(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+# Stored snapshots, newest first
+def list_schedule_snapshots():
+    return sorted(glob.glob(os.path.join(SCHEDULE_SNAPSHOT_DIR, "*.parquet")), reverse=True)
+
+
+def schedule_snapshot_label(path):
+    import pyarrow.parquet as pq
+
+    taken = time.strptime(os.path.basename(path).rsplit(' ', 1)[0], '%Y-%m-%d %H%M%S')
+    return f"Snapshot of {time.strftime('%d %B %Y %H:%M', taken)} ({pq.read_metadata(path).num_rows:,} members)"
+
+
+def load_schedule_snapshot(path):
+    df_schedule = pd.read_parquet(path)
+
+    # The member code key is the first column of the schedule, snapshots taken before they
+    # were keyed have no key
+    if df_schedule.index.name is not None:
+        df_schedule = df_schedule.reset_index()
+
+    # Parquet gives back empty cells as None, the workbook as NaN
+    for column in df_schedule.columns:
+        df_schedule[column] = df_schedule[column].where(df_schedule[column].notna(), np.nan)
+    return df_schedule
+
+
 def main():
     st.markdown("""
         <style>
@@ -145,38 +250,100 @@ def main():
     st.write("`CODE | SURNAME | INITIALS | ID | DOB | PASSPORT | GROUP | GENDER | DATE ENGAGED | DATE TERMINATED`")
 
     # File uploaders
-    avbob_file = st.file_uploader("Upload the previous month's schedule", type=["xlsx", "xls"])
+    # The previous month's schedule, from a snapshot of an earlier run unless it is uploaded.
+    # Nothing is picked by default, the newest snapshot is often the schedule this month's
+    # run already made.
+    snapshots = {schedule_snapshot_label(path): path for path in list_schedule_snapshots()}
+    upload_instead = "Upload the schedule instead"
+    choice = upload_instead
+    if snapshots:
+        choice = st.selectbox("Previous month's schedule", [*snapshots, upload_instead], index=None,
+                              placeholder="Choose the snapshot of last month's schedule")
+    snapshot = snapshots.get(choice)
+    avbob_file = None
+    if choice == upload_instead:
+        avbob_file = st.file_uploader("Upload the previous month's schedule", type=["xlsx", "xls"])
     new_file = st.file_uploader("Upload New Employees Data", type=["xlsx", "xls"])
     terminate_file = st.file_uploader("Upload Terminations Data", type=["xlsx", "xls"])
 
+    output_formats = select_output_formats()
+
+    # Converted files are only kept on disk when asked for
+    save_copy = st.checkbox("Also save a copy of the schedule in temp/")
+    show_details = st.checkbox("Show performance details")
+
+    # The faster Excel backend is only used when asked for
+    engine = EXCEL_ENGINE
+    if CALAMINE_INSTALLED and st.checkbox("Read the workbooks with calamine (faster, not yet compared with openpyxl)"):
+        engine = "calamine"
+
+    # 'Go' builds the schedule as a job. It runs in the background, so reruns of the page
+    # don't stop it, and its downloads stay on the page until they are cleared.
     if st.button("Go"):
-        if avbob_file and new_file and terminate_file:
-            try:
-                df_new_avbob, df_new_sheet, df_terminations = process_employee_data(avbob_file, new_file, terminate_file)
-
-                # Download processed data
-                output_file_path = "temp/final_output.xlsx"
-                with pd.ExcelWriter(output_file_path, engine='xlsxwriter') as writer:
-                    df_new_avbob.to_excel(writer, sheet_name='ACTIVE', index=False)
-                    df_new_sheet.to_excel(writer, sheet_name='NEW EMPLOYEES', index=False)
-                    df_terminations.to_excel(writer, sheet_name='TERMINATIONS', index=False)
-
-                with open(output_file_path, "rb") as f:
-                    st.download_button(
-                        label="Download Processed File",
-                        data=f,
-                        file_name="final_output.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-
-            except ValueError as ve:
-                st.error(f"Validation Error: {ve}")
-            except Exception as e:
-                st.error(f"An unexpected error occurred: {e}")
-                logging.error(f"Unexpected error: {e}")
+        if (snapshot or avbob_file) and new_file and terminate_file:
+            start_job('avbob', f"Schedule: {new_file.name}, {terminate_file.name}", build_schedule,
+                      job_file(avbob_file), snapshot, job_file(new_file), job_file(terminate_file), save_copy,
+                      output_formats, show_details, engine)
         else:
             st.error("Please upload all the required files before clicking 'Go'.")
             st.write("Please ensure all uploaded files are in .xlsx format with the newest Excel engine.")
 
+    show_jobs('avbob', show_conversion)
+
+
+# Build the schedule and its downloads without showing anything, so it can run as a job.
+# The previous schedule is the uploaded avbob_file, or the snapshot when one is picked.
+# Returns what the page shows afterwards.
+def build_schedule(avbob_file, snapshot, new_file, terminate_file, save_copy, output_formats=('xlsx',),
+                   show_details=False, engine=EXCEL_ENGINE):
+    messages = []
+    downloads = []
+    with record_stages(stages_enabled(show_details), show_details) as records:
+        if snapshot:
+            with stage("load snapshot") as record:
+                avbob_file = load_schedule_snapshot(snapshot)
+                record['rows'] = len(avbob_file)
+
+        try:
+            df_new_avbob, df_new_sheet, df_terminations = process_employee_data(
+                avbob_file, new_file, terminate_file, engine)
+
+            delta = df_new_avbob.attrs['delta']
+            messages.append(('write', f"Previous schedule: {delta['previous']:,} members. Added {delta['added']:,} "
+                                      f"new employees, removed {delta['terminated']:,} terminated members, "
+                                      f"{len(df_new_avbob):,} members now."))
+            if delta['unmatched terminations']:
+                messages.append(('warning', f"{delta['unmatched terminations']:,} terminated employee codes are "
+                                            f"not on the schedule."))
+
+            # Next month's run can start from this schedule
+            with stage("save snapshot") as record:
+                save_schedule_snapshot(df_new_avbob)
+                record['rows'] = len(df_new_avbob)
+
+            # Download processed data, built in memory. Excel gets a sheet each, the other
+            # formats a ZIP file with a file each.
+            sheets = {'ACTIVE': df_new_avbob, 'NEW EMPLOYEES': df_new_sheet, 'TERMINATIONS': df_terminations}
+            for output_format in output_formats:
+                with stage(f"write {output_format}") as record:
+                    data, file_name, mime = to_format_sheets(sheets, output_format, "final_output")
+                    record['rows'] = len(df_new_avbob) + len(df_new_sheet) + len(df_terminations)
+
+                if save_copy:
+                    save_output_copy(data, file_name)
+
+                label = "Download Processed File" if len(output_formats) == 1 else \
+                    f"Download Processed File ({file_name})"
+                downloads.append(download(data, file_name, label, mime))
+
+        except ValueError as ve:
+            messages.append(('error', f"Validation Error: {ve}"))
+        except Exception as e:
+            messages.append(('error', f"An unexpected error occurred: {e}"))
+            logging.error(f"Unexpected error: {e}")
+
+    return {'messages': messages, 'downloads': downloads, 'records': records, 'show_details': show_details}
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,73 +1,158 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
 import io
-
-# List to hold filenames of files that cause errors
-error_files = []
+import os
+import shutil
+import threading
+import time
+import utils
+from utils import (OUTPUT_FORMATS, cancel_job, convert_as_completed, download, format_dates, job_file,
+                   job_finished, offer_downloads, record_stages, result_cache_key, save_output_copy,
+                   select_output_formats, session_jobs, show_jobs, show_messages, show_paged_preview,
+                   show_stage_records, source_version, stage, stages_enabled, start_job, to_format_bytes)
+
+# Columns kept from every batch file, a file needs all of them
+BATCH_COLUMNS = [1, 2, 5, 7, 17]
+
+# In incremental mode every processed batch file is kept here, as a Parquet file named
+# after the hash of the batch file, and listed in the manifest
+BATCH_STORE_DIR = os.path.join("temp", "batches")
+BATCH_MANIFEST = os.path.join(BATCH_STORE_DIR, "manifest.csv")
+BATCH_MANIFEST_COLUMNS = ['KEY', 'FILE', 'ROWS', 'STORED']
+_batch_manifest_lock = threading.Lock()
+
+
+# Function to process individual files. The names of files that fail are added to
+# error_files when it is given.
+def file_processor(uploaded_file, error_files=None):
+    df, error = convert_batch_file(uploaded_file)
+    if error:
+        if error_files is not None:
+            error_files.append(uploaded_file.name)
+        st.error(error)
+    return df
 
 
-# Function to process individual files
-def file_processor(uploaded_file):
+# Convert one batch file. Returns the cleaned dataframe and an error message, so files
+# can be converted in worker threads and the errors shown afterwards.
+def convert_batch_file(uploaded_file):
     try:
-        # Read the entire file with the correct delimiter
-        df = pd.read_csv(uploaded_file, sep=';', header=None, encoding='ISO-8859-1', engine='python')
-        expected_columns = [1, 2, 5, 7, 17]
-
-        # Check if these columns exist in the dataframe
-        if len(df.columns) < 18:
-            error_files.append(uploaded_file.name)
-            st.error(f"{uploaded_file.name} doesn't have enough columns.")
-            return None
-
-        # Select only the relevant columns if they exist
-        df = df.iloc[:, expected_columns]
+        with stage("read") as record:
+            # The first row decides how many columns the file has
+            columns = len(pd.read_csv(uploaded_file, sep=';', header=None, encoding='ISO-8859-1', nrows=1).columns)
+            uploaded_file.seek(0)
+
+            # Check if these columns exist in the dataframe. The whole file is still read,
+            # so rows longer than the first one are reported as before.
+            if columns <= max(BATCH_COLUMNS):
+                pd.read_csv(uploaded_file, sep=';', header=None, encoding='ISO-8859-1', engine='python')
+                return None, f"{uploaded_file.name} doesn't have enough columns."
+
+            # Read with the C parser, then keep the columns that are used. Every column is read,
+            # so rows longer than the first one are rejected. Column types are decided on the
+            # whole column, the same as the python parser, not on every block of rows.
+            try:
+                df = pd.read_csv(uploaded_file, sep=';', header=None, encoding='ISO-8859-1', low_memory=False)
+            except pd.errors.ParserError:
+                # The file is reported with the error of the python parser, the same as before
+                uploaded_file.seek(0)
+                pd.read_csv(uploaded_file, sep=';', header=None, encoding='ISO-8859-1', engine='python')
+                raise
+            df = df[BATCH_COLUMNS]
+            record['rows'] = len(df)
 
         # Rename columns (adjust according to data example)
         df.columns = ['DATE', 'ACCOUNT NUMBER', 'CREDITOR NAME', 'AMOUNT', 'BATCH NAME']
 
-        # Clean up data (e.g., remove extra spaces, convert amounts)
-        df['ACCOUNT NUMBER'] = df['ACCOUNT NUMBER'].str.strip()  # Remove any leading/trailing spaces
-        df['ACCOUNT NUMBER'] = df['ACCOUNT NUMBER'].apply(lambda x: x.lstrip('0') if isinstance(x, str) else x)  # Remove leading zeros
-        df['CREDITOR NAME'] = df['CREDITOR NAME'].str.strip()
+        with stage("convert") as record:
+            # Clean up data (e.g., remove extra spaces, convert amounts)
+            df['ACCOUNT NUMBER'] = df['ACCOUNT NUMBER'].str.strip()  # Remove any leading/trailing spaces
+            df['ACCOUNT NUMBER'] = df['ACCOUNT NUMBER'].str.lstrip('0')  # Remove leading zeros
+            df['CREDITOR NAME'] = df['CREDITOR NAME'].str.strip()
 
-        # Fix the date column
-        df = date_fixer(df)
+            # Fix the date column
+            df = date_fixer(df)
 
-        # Convert the 'AMOUNT' column to integer (after removing any extra characters, like spaces)
-        df['AMOUNT'] = pd.to_numeric(df['AMOUNT'], errors='coerce') / 100  # Handle invalid values gracefully
-        df = df.iloc[1:-2]
+            # Convert the 'AMOUNT' column to integer (after removing any extra characters, like spaces)
+            df['AMOUNT'] = pd.to_numeric(df['AMOUNT'], errors='coerce') / 100  # Handle invalid values gracefully
+            df = df.iloc[1:-2]
+            record['rows'] = len(df)
         # Return the cleaned dataframe
-        return df
+        return df, None
 
     except pd.errors.EmptyDataError:
         # Handle empty files separately
-        error_files.append(uploaded_file.name)
-        st.error(f"{uploaded_file.name} is empty or doesn't contain valid data.")
-        return None
+        return None, f"{uploaded_file.name} is empty or doesn't contain valid data."
     except Exception as e:
         # Handle other errors
-        error_files.append(uploaded_file.name)
-        st.error(f"Error reading {uploaded_file.name}: {e}")
-        return None
+        return None, f"Error reading {uploaded_file.name}: {e}"
+
+
+# Store key of a batch file, a hash of its contents and of the code that processes it,
+# so changes to the converter never load frames stored by an older version
+def batch_file_key(uploaded_file):
+    return result_cache_key(uploaded_file.getvalue(), 'batches', source_version(__file__, utils.__file__))
+
+
+def batch_store_path(key):
+    return os.path.join(BATCH_STORE_DIR, key + ".parquet")
+
+
+# Load a batch file processed in an earlier run, or process it and store it for the
+# next. Only files that processed without errors are stored.
+def load_or_convert_batch_file(uploaded_file):
+    key = batch_file_key(uploaded_file)
+    path = batch_store_path(key)
+    if os.path.exists(path):
+        with stage("load stored") as record:
+            df = pd.read_parquet(path)
+
+            # Parquet gives back empty text as None, the processed frame had NaN
+            for column in df.columns[df.dtypes == object]:
+                df[column] = df[column].where(df[column].notna(), np.nan)
+            record['rows'] = len(df)
+        return df, None
+
+    df, error = convert_batch_file(uploaded_file)
+    if error is None:
+        store_batch_frame(key, uploaded_file.name, df)
+    return df, error
+
+
+def store_batch_frame(key, file_name, df):
+    os.makedirs(BATCH_STORE_DIR, exist_ok=True)
+
+    # Written under a temporary name first, so a half written file is never loaded
+    path = batch_store_path(key)
+    df.to_parquet(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    # Files are stored from worker threads, only one at a time adds to the manifest
+    entry = pd.DataFrame([[key, file_name, len(df), time.strftime('%Y-%m-%d %H:%M:%S')]],
+                         columns=BATCH_MANIFEST_COLUMNS)
+    with _batch_manifest_lock:
+        entry.to_csv(BATCH_MANIFEST, mode='a', header=not os.path.exists(BATCH_MANIFEST), index=False)
+
+
+def read_batch_manifest():
+    if not os.path.exists(BATCH_MANIFEST):
+        return pd.DataFrame(columns=BATCH_MANIFEST_COLUMNS)
+    return pd.read_csv(BATCH_MANIFEST)
 
 
 # Function to fix the date column
 def date_fixer(df):
     # Handle date format (assuming the first row has the date, or adjust as needed)
     date = df.iloc[0, 0]  # Get the date from the first row
-    df['DATE'] = date
-    df['DATE'] = pd.to_datetime(df['DATE'].astype(str), format='%Y%m%d')
 
-    # Change the format to dd/mm/yyyy
-    df['DATE'] = df['DATE'].dt.strftime('%d/%m/%Y')
+    # Parse it once and change the format to dd/mm/yyyy for every row
+    df['DATE'] = format_dates(pd.Series([str(date)]), errors='raise').iloc[0]
 
     return df
 
 
 def main():
-    # List to hold file paths
-    path_names = []
-
     # Streamlit UI
     st.markdown("""
             <style>
@@ -101,51 +186,150 @@ def main():
     # File uploader widget for multiple files
     uploaded_files = st.file_uploader("UPLOAD ALL BATCHES", accept_multiple_files=True)
 
-    # If files are uploaded, process them
-    if uploaded_files:
-        # Create an empty list to hold processed dataframes
-        processed_dfs = []
+    output_formats = select_output_formats()
+
+    # Converted files are only kept on disk when asked for
+    save_copy = st.checkbox("Also save a copy of the processed file in temp/")
+    show_details = st.checkbox("Show performance details")
 
-        # Process each uploaded file
-        for uploaded_file in uploaded_files:
-            # Add file name to path_names list
-            path_names.append(uploaded_file.name)
+    # Files processed in an earlier run are loaded from the store instead of processed again
+    incremental = st.checkbox("Incremental mode (reuse batch files processed before)")
+    if incremental:
+        manifest = read_batch_manifest()
+        st.caption(f"{len(manifest):,} batch files stored in {BATCH_STORE_DIR}")
+        if len(manifest) and st.button("Clear stored batch files"):
+            shutil.rmtree(BATCH_STORE_DIR, ignore_errors=True)
+            st.success("Stored batch files cleared.")
 
-            # Process the file and get the dataframe
-            df = file_processor(uploaded_file)
+    # Uploaded files are processed as a job in the background, so reruns of the page don't
+    # stop it. A new job is only started when the files or the options change.
+    if uploaded_files:
+        options = (tuple(output_formats), save_copy, incremental, show_details)
+        job_key = (tuple(uploaded_file.file_id for uploaded_file in uploaded_files), options)
+        # The last job is started again once it is cleared from the page
+        last_job = st.session_state.get('batches last job')
+        if last_job is not None and all(job is not last_job for job in session_jobs('batches')):
+            last_job = None
+        if last_job is None or last_job['batch key'] != job_key:
+            # The job for files that are no longer wanted is cancelled. It only stops at its
+            # next stage, so the new job reads its own copies of the files.
+            if last_job is not None and not job_finished(last_job):
+                cancel_job(last_job)
+            job = start_job('batches', f"{len(uploaded_files)} batch files", convert_uploaded_files,
+                            [job_file(uploaded_file) for uploaded_file in uploaded_files], save_copy,
+                            output_formats, incremental, show_details)
+            job['batch key'] = job_key
+            st.session_state['batches last job'] = job
+    else:
+        st.write("Please upload some files.")
 
+    show_jobs('batches', show_batches)
+
+
+# Totals of the processed files, added to as soon as every file is converted. Files come in
+# the order they finish, so every file keeps its position in the upload.
+def new_summary():
+    return {'rows': 0, 'file_rows': [], 'batch_amounts': pd.Series(dtype=float)}
+
+
+def add_to_summary(summary, position, file_name, df):
+    summary['rows'] += len(df)
+    summary['file_rows'].append((position, file_name, len(df)))
+    summary['batch_amounts'] = summary['batch_amounts'].add(
+        df.groupby('BATCH NAME', dropna=False)['AMOUNT'].sum(), fill_value=0)
+
+
+def show_summary(summary):
+    st.write(f"Rows: {summary['rows']:,}")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("Total amount per batch:")
+        st.dataframe(summary['batch_amounts'].rename_axis('BATCH NAME').reset_index(name='AMOUNT'), hide_index=True)
+    with col2:
+        st.write("Rows per file:")
+        file_rows = [(file_name, rows) for _, file_name, rows in sorted(summary['file_rows'])]
+        st.dataframe(pd.DataFrame(file_rows, columns=['FILE', 'ROWS']), hide_index=True)
+
+
+# Process the uploaded files and build the downloads without showing anything, so it can
+# run as a job. Returns what the page shows afterwards.
+def convert_uploaded_files(uploaded_files, save_copy, output_formats=('xlsx',), incremental=False,
+                           show_details=False):
+    # Create an empty list to hold processed dataframes, and one for the names of the
+    # files that caused errors in this run
+    processed_dfs = []
+    error_files = []
+    messages = []
+    downloads = []
+    summary = new_summary()
+
+    with record_stages(stages_enabled(show_details), show_details) as records:
+        # Process the uploaded files in a pool of worker threads, every file is added to the
+        # totals as soon as it is converted
+        results = [None] * len(uploaded_files)
+        for position, (df, error) in convert_as_completed(
+                load_or_convert_batch_file if incremental else convert_batch_file, uploaded_files):
+            results[position] = (df, error)
+            if not error:
+                add_to_summary(summary, position, uploaded_files[position].name, df)
+
+        # Then go through the results in upload order
+        for uploaded_file, (df, error) in zip(uploaded_files, results):
             # If the file failed to process, skip it
-            if df is None:
+            if error:
+                error_files.append(uploaded_file.name)
+                messages.append(('error', error))
                 continue
 
             # Append the processed dataframe to the list
             processed_dfs.append(df)
 
-        # Concatenate all dataframes into one
         if processed_dfs:
+            # Concatenate all dataframes into one, only the downloads need the whole file
             final_df = pd.concat(processed_dfs, ignore_index=True)
 
-            # Show the concatenated dataframe (this is the preview for the final file)
-            st.write("Final Preview:")
-            st.write(final_df)
+            for output_format in output_formats:
+                # Build the file from the final concatenated dataframe in memory
+                with stage(f"write {output_format}") as record:
+                    data = to_format_bytes(final_df, output_format)
+                    record['rows'] = len(final_df)
+
+                extension, mime = OUTPUT_FORMATS[output_format]
+                file_name = f"processed_files{extension}"
+                if save_copy:
+                    save_output_copy(data, file_name)
+
+                label = "Download Processed Excel File" if output_format == 'xlsx' else \
+                    f"Download Processed {output_format.upper()} File"
+                downloads.append(download(data, file_name, label, mime))
+
+    return {'messages': messages, 'processed_dfs': processed_dfs, 'summary': summary, 'downloads': downloads,
+            'error_files': error_files, 'records': records, 'show_details': show_details}
 
-            # Save the final concatenated dataframe to an Excel file
-            final_df.to_excel("processed_files.xlsx", index=False)
 
-            # Provide the user with a download button for the Excel file
-            with open("processed_files.xlsx", "rb") as f:
-                st.download_button("Download Processed Excel File", f, file_name="processed_files.xlsx",
-                                   mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+# Show processed files once they are done, key keeps apart the previews and downloads of
+# different jobs
+def show_batches(result, key=''):
+    show_messages(result['messages'])
 
-            # Display error files, if any
-            if error_files:
-                st.write("The following files caused errors and were skipped:")
-                st.write(error_files)
+    if result['processed_dfs']:
+        # Show a page of the final file at a time, with the totals of all files
+        st.write("Final Preview:")
+        show_paged_preview(result['processed_dfs'], f"batches preview {key}")
+        show_summary(result['summary'])
+
+        # Provide the user with a download button for every file
+        offer_downloads(result['downloads'], key)
+
+        # Display error files, if any
+        if result['error_files']:
+            st.write("The following files caused errors and were skipped:")
+            st.write(result['error_files'])
 
-        else:
-            st.write("No files processed successfully.")
     else:
-        st.write("Please upload some files.")
+        st.write("No files processed successfully.")
+
+    show_stage_records(result['records'], result['show_details'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+import pandas as pd
+
+RESULT_COLUMNS = ['measurement', 'target', 'runs', 'median_seconds', 'min_seconds']
+
+# Modules timed on import, and the app pages timed on their first paint and rerun
+IMPORT_TARGETS = ['BANKS', 'pages.AVBOB', 'pages.BATCHES', 'cli']
+PAGE_TARGETS = ['BANKS.py', 'pages/AVBOB.py', 'pages/BATCHES.py']
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter, so nothing is imported yet. Streamlit is loaded before the
+# clock starts, the same as in the app where the server has already imported it.
+IMPORT_CODE = """
+import time
+import streamlit
+start = time.perf_counter()
+import {target}
+print(time.perf_counter() - start)
+"""
+
+PAGE_CODE = """
+import time
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file({path!r}, default_timeout=120)
+start = time.perf_counter()
+app.run()
+first_paint = time.perf_counter() - start
+start = time.perf_counter()
+app.run()
+print(first_paint, time.perf_counter() - start)
+"""
+
+
+# Seconds printed on the last line by the code, run in a fresh interpreter
+def run_timed(code):
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return [float(seconds) for seconds in result.stdout.strip().splitlines()[-1].split()]
+
+
+def summarize(measurement, target, seconds):
+    return {'measurement': measurement, 'target': target, 'runs': len(seconds),
+            'median_seconds': round(statistics.median(seconds), 4), 'min_seconds': round(min(seconds), 4)}
+
+
+def benchmark_imports(results, runs):
+    for target in IMPORT_TARGETS:
+        seconds = [run_timed(IMPORT_CODE.format(target=target))[0] for _ in range(runs)]
+        results.append(summarize('import', target, seconds))
+
+
+def benchmark_pages(results, runs):
+    for target in PAGE_TARGETS:
+        timings = [run_timed(PAGE_CODE.format(path=os.path.join(REPO_DIR, target))) for _ in range(runs)]
+        results.append(summarize('first paint', target, [first_paint for first_paint, _ in timings]))
+        results.append(summarize('rerun', target, [rerun for _, rerun in timings]))
+
+
+# Measurements that got slower than the baseline by more than the tolerance
+def find_regressions(summary, baseline, tolerance):
+    compared = summary.merge(baseline, on=['measurement', 'target'], suffixes=('', '_baseline'))
+    slower = compared['median_seconds'] > compared['median_seconds_baseline'] * (1 + tolerance)
+    return compared[slower]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import time, first paint and rerun time of the app.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement (default 5)")
+    parser.add_argument("--no-pages", action="store_true", help="only measure import times")
+    parser.add_argument("--output", help="write the results to this CSV file")
+    parser.add_argument("--baseline", help="results CSV of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown against the baseline that counts as a regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    results = []
+    benchmark_imports(results, args.runs)
+    if not args.no_pages:
+        benchmark_pages(results, args.runs)
+
+    summary = pd.DataFrame(results, columns=RESULT_COLUMNS)
+    print(summary.to_string(index=False))
+    if args.output:
+        summary.to_csv(args.output, index=False)
+
+    if args.baseline:
+        regressions = find_regressions(summary, pd.read_csv(args.baseline), args.tolerance)
+        if not regressions.empty:
+            print(f"\n{len(regressions)} measurements are more than {args.tolerance:.0%} slower than the baseline:")
+            print(regressions[['measurement', 'target', 'median_seconds', 'median_seconds_baseline']]
+                  .to_string(index=False))
+            return 1
+        print(f"\nNo measurement is more than {args.tolerance:.0%} slower than the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+import os
+import shutil
+
+import pandas as pd
+
+import cli
+from utils import (AUDIT_MATCHED_FILE, AUDIT_UNMATCHED_FILE, audit_lines, audit_run_folder, stage_source,
+                   write_audit_lines)
+
+ABSA_STATEMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "temp",
+                              "ABSA STATEMENT.csv")
+
+
+# The same statement converted in two runs, from two sessions or two CLI runs, is written
+# to two run folders
+def test_every_run_gets_its_own_folder(tmp_path):
+    lines = pd.Series(['ABC123 PAYMENT', 'SERVICE FEE'])
+    for _ in range(2):
+        with audit_lines(audit_run_folder(str(tmp_path))), stage_source("statement.txt"):
+            write_audit_lines(lines.to_frame('LINE'), pd.Series(['ABC123', None]), pd.Series(['pattern8', None]))
+
+    run_folders = os.listdir(tmp_path)
+    assert len(run_folders) == 2
+    for run_folder in run_folders:
+        assert pd.read_csv(tmp_path / run_folder / "statement.txt" / AUDIT_MATCHED_FILE)['CODE'].tolist() == ['ABC123']
+
+
+# Two statements with the same name from two directories, converted in two worker processes
+# of one run, each keep their own audit files
+def test_statements_with_the_same_name_are_not_overwritten(tmp_path):
+    for directory in ("first", "second"):
+        os.makedirs(tmp_path / directory)
+        shutil.copy(ABSA_STATEMENT, tmp_path / directory / "statement.csv")
+    audit_dir = tmp_path / "audit"
+
+    assert cli.main([str(tmp_path / "first"), str(tmp_path / "second"), "--bank", "absa", "--workers", "2",
+                     "--output-dir", str(tmp_path / "converted"), "--audit-dir", str(audit_dir)]) == 0
+
+    [run_folder] = os.listdir(audit_dir)
+    assert sorted(os.listdir(audit_dir / run_folder)) == ["statement.csv", "statement.csv (2)"]
+    for folder in os.listdir(audit_dir / run_folder):
+        assert set(os.listdir(audit_dir / run_folder / folder)) <= {AUDIT_MATCHED_FILE, AUDIT_UNMATCHED_FILE}
+        assert os.listdir(audit_dir / run_folder / folder)
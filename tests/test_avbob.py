@@ -0,0 +1,47 @@
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+from generate import generate_avbob
+from pages import AVBOB
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(AVBOB, 'SCHEDULE_SNAPSHOT_DIR', str(tmp_path / "snapshots"))
+    return generate_avbob(str(tmp_path), 200, np.random.default_rng(0))
+
+
+def test_snapshot_is_keyed_by_member_code(files):
+    df_schedule, _, _ = AVBOB.process_employee_data(files['schedule'], files['new'], files['terminations'])
+    path = AVBOB.save_schedule_snapshot(df_schedule)
+
+    assert pd.read_parquet(path).index.name == df_schedule.columns[0]
+    pd.testing.assert_frame_equal(AVBOB.load_schedule_snapshot(path),
+                                  AVBOB.schedule_snapshot_frame(df_schedule).reset_index(drop=True))
+
+
+# The snapshot of this month's run already has the new employees, using it as last
+# month's schedule would add them twice
+def test_new_employees_already_on_the_schedule_are_rejected(files):
+    df_schedule, _, _ = AVBOB.process_employee_data(files['schedule'], files['new'], files['terminations'])
+    snapshot = AVBOB.load_schedule_snapshot(AVBOB.save_schedule_snapshot(df_schedule))
+
+    with pytest.raises(ValueError, match="new employee codes are already on the previous schedule"):
+        AVBOB.process_employee_data(snapshot, files['new'], files['terminations'])
+
+
+# A stray cell right of the header row is read as an extra column, the file is rejected the
+# same as one with an extra header
+@pytest.mark.parametrize('kind, cell, message', [
+    ('new', 'J5', "The new employee data file only has 10 columns, it should have 9."),
+    ('terminations', 'K5', "The termination data file only has 11 columns, it should have 10."),
+])
+def test_stray_cell_past_the_header_is_rejected(files, kind, cell, message):
+    workbook = openpyxl.load_workbook(files[kind])
+    workbook.active[cell] = "stray"
+    workbook.save(files[kind])
+
+    with pytest.raises(ValueError, match=message):
+        AVBOB.process_employee_data(files['schedule'], files['new'], files['terminations'])
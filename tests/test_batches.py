@@ -0,0 +1,80 @@
+import io
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from generate import generate_batches
+import utils
+from pages.BATCHES import convert_batch_file, file_processor
+
+
+# The batch file reader before it was changed to the C parser, kept to compare against
+def legacy_file_processor(uploaded_file):
+    df = pd.read_csv(uploaded_file, sep=';', header=None, encoding='ISO-8859-1', engine='python')
+    df = df.iloc[:, [1, 2, 5, 7, 17]]
+    df.columns = ['DATE', 'ACCOUNT NUMBER', 'CREDITOR NAME', 'AMOUNT', 'BATCH NAME']
+    df['ACCOUNT NUMBER'] = df['ACCOUNT NUMBER'].str.strip()
+    df['ACCOUNT NUMBER'] = df['ACCOUNT NUMBER'].apply(lambda x: x.lstrip('0') if isinstance(x, str) else x)
+    df['CREDITOR NAME'] = df['CREDITOR NAME'].str.strip()
+    df['DATE'] = df.iloc[0, 0]
+    df['DATE'] = pd.to_datetime(df['DATE'].astype(str), format='%Y%m%d').dt.strftime('%d/%m/%Y')
+    df['AMOUNT'] = pd.to_numeric(df['AMOUNT'], errors='coerce') / 100
+    return df.iloc[1:-2]
+
+
+def upload(path):
+    with open(path, 'rb') as f:
+        uploaded_file = io.BytesIO(f.read())
+    uploaded_file.name = path.name
+    return uploaded_file
+
+
+# Large enough for the C parser to read the file in several blocks of rows
+@pytest.mark.parametrize('rows', [1_000, 50_000])
+def test_file_processor_matches_legacy_reader(tmp_path, rows):
+    path = generate_batches(tmp_path / "batches.txt", rows, np.random.default_rng(0))
+
+    df = file_processor(upload(path))
+    expected = legacy_file_processor(upload(path))
+
+    assert df['ACCOUNT NUMBER'].notna().all()
+    pd.testing.assert_frame_equal(df, expected)
+
+
+# A detail row with more fields than the header row is rejected with the error of the legacy
+# reader
+def test_longer_row_is_rejected_as_before(tmp_path):
+    path = generate_batches(tmp_path / "batches.txt", 50, np.random.default_rng(0))
+    lines = path.read_text(encoding='ISO-8859-1').splitlines()
+    lines[4] += ';EXTRA' * 5
+    path.write_text('\n'.join(lines) + '\n', encoding='ISO-8859-1')
+
+    with pytest.raises(pd.errors.ParserError) as legacy_error:
+        legacy_file_processor(upload(path))
+    df, error = convert_batch_file(upload(path))
+
+    assert df is None
+    assert error == f"Error reading {path.name}: {legacy_error.value}"
+    assert "Expected 22 fields in line 5, saw 23" in error
+
+
+# The summary is added to as every file is converted, the first file is only let through
+# after the second one was handed back
+def test_files_are_handed_back_as_they_finish(monkeypatch):
+    monkeypatch.setattr(utils, 'CONVERT_WORKERS', 2)
+    second_done = threading.Event()
+
+    def convert(file):
+        if file == 'first':
+            assert second_done.wait(timeout=10)
+        return file.upper()
+
+    handed_back = []
+    for position, result in utils.convert_as_completed(convert, ['first', 'second']):
+        handed_back.append((position, result))
+        second_done.set()
+
+    assert handed_back == [(1, 'SECOND'), (0, 'FIRST')]
+    assert utils.convert_concurrently(lambda file: file.upper(), ['first', 'second']) == ['FIRST', 'SECOND']
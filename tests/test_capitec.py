@@ -0,0 +1,49 @@
+import os
+
+from BANKS import convert_bank_files, try_convert_capitec_bank_file
+
+STATEMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "temp", "CAPITEC STATEMENT.csv")
+
+
+def test_statement_converts():
+    df, error = try_convert_capitec_bank_file(STATEMENT)
+
+    assert error is None
+    assert (df['AMOUNT'] == -4829158).any()
+
+
+# A comma in a reference gives its row one field more than the others. The statement is
+# rejected, the row's columns are never shifted.
+def test_row_with_extra_field_is_rejected(tmp_path):
+    with open(STATEMENT) as f:
+        text = f.read()
+    path = tmp_path / "statement.csv"
+    path.write_text(text.replace("D524 B 31DES", "REF A,REF B", 1))
+
+    df, error = try_convert_capitec_bank_file(str(path))
+
+    assert df is None
+    assert "Expected 7 fields in line 6, saw 8" in error
+
+
+# A statement whose references are all blank fails on its own, with a message, and the
+# other statements of the run are still converted
+def test_failing_statement_does_not_fail_the_others(tmp_path):
+    with open(STATEMENT) as f:
+        lines = f.read().splitlines()
+    blanked = lines[:3]
+    for line in lines[3:]:
+        fields = line.split(',')
+        if len(fields) > 3:
+            fields[3] = ''
+        blanked.append(','.join(fields))
+    path = tmp_path / "blank references.csv"
+    path.write_text('\n'.join(blanked) + '\n')
+
+    df, error = try_convert_capitec_bank_file(str(path))
+    assert df is None
+    assert error.startswith(f"Error processing file {path}: ")
+
+    result = convert_bank_files([str(path), STATEMENT], 'capitec')
+    assert [kind for kind, _ in result['messages']].count('error') == 1
+    assert result['downloads']
@@ -0,0 +1,18 @@
+import io
+
+from utils import job_file
+
+
+# Every job reads its own copy, so a job reading the file doesn't move another job's
+# read position
+def test_job_files_are_read_apart():
+    uploaded_file = io.BytesIO(b"first line\nsecond line\n")
+    uploaded_file.name = "batch.txt"
+
+    first, second = job_file(uploaded_file), job_file(uploaded_file)
+    first.readline()
+
+    assert second.readline() == b"first line\n"
+    assert uploaded_file.tell() == 0
+    assert (first.name, second.name) == ("batch.txt", "batch.txt")
+    assert job_file(None) is None
@@ -0,0 +1,26 @@
+import tracemalloc
+
+from utils import record_stages, stage
+
+
+# Stages logged without the details shown are only timed, memory is not traced for them
+def test_memory_is_only_traced_when_asked_for():
+    with record_stages() as records:
+        assert not tracemalloc.is_tracing()
+        with stage("convert") as record:
+            record['rows'] = 10
+
+    assert records[0]['rows'] == 10
+    assert records[0]['seconds'] >= 0
+    assert records[0]['peak_mb'] is None
+
+
+def test_traced_stages_measure_their_peak_memory():
+    with record_stages(trace_memory=True) as records:
+        assert tracemalloc.is_tracing()
+        with stage("convert"):
+            data = bytearray(4 * 2 ** 20)
+        del data
+
+    assert not tracemalloc.is_tracing()
+    assert records[0]['peak_mb'] >= 4
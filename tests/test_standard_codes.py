@@ -0,0 +1,81 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from BANKS import get_matching_codes, read_standard_bank_file
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The Standard Bank code patterns as they were matched one line at a time, before they
+# were compiled into one matcher. Kept to compare against.
+LEGACY_PATTERNS = [
+    (r'^\d{2}[A-Z]{3}\d{4}\b', 'pattern6'),
+    (r'^\d{2}[A-Z]{4}\d{3}\b', 'pattern2'),
+    (r'^\d{2}[A-Z]{3}\d{3}\b', 'pattern1'),
+    (r'^[A-Z]{3}\d{4}\b', 'pattern7'),
+    (r'^[A-Z]{3}\d{3}\b', 'pattern8'),
+    (r'^\d[A-Z]{2}\d{3}\b', 'pattern3'),
+    (r'^\d[A-Z]{3}\d{3}\b', 'pattern4'),
+    (r'^[A-Z]{2}\d{4}\b', 'pattern5'),
+    (r'^\d[A-Z]{4}\d{2}\b', 'pattern9'),
+    (r'^\d[A-Z]{4}\b', 'pattern10'),
+    (r'^[A-Z]{4}\d{2}\b', 'pattern11'),
+    (r'^\d[A-Z]{4}\d{4}\b', 'pattern14'),
+    (r'^[A-Z]{3}\d{3}\b', 'pattern12'),
+]
+
+
+def legacy_get_matching_code(line):
+    line = str(line).strip()
+
+    # Pattern 13: 'DIV' followed by one or two numbers, anywhere in the line
+    match13 = re.search(r'\bDIV(\d{1,2})\b', line)
+    if match13:
+        code = match13.group(1)
+        if code + ':' in line:
+            return None, None
+        return code, 'pattern13'
+
+    for pattern, name in LEGACY_PATTERNS:
+        match = re.search(pattern, line)
+        if match:
+            code = match.group(0)
+            if code + ':' in line:
+                return None, None
+            return code, name
+    return None, None
+
+
+def assert_same_codes(lines):
+    lines = pd.Series(lines, dtype=object)
+    codes, patterns = get_matching_codes(lines)
+    assert list(zip(codes, patterns)) == [legacy_get_matching_code(line) for line in lines]
+
+
+@pytest.mark.parametrize('line', [
+    'DIV12 SOMETHING', 'PAYMENT DIV5', 'XDIV12 PAYMENT', 'DIV12:', 'DIV12: DIV12', 'DIV1 12:', 'DIV123',
+    'DIV123 DIV4', 'ABC123 DIV4', 'DIV4 ABC123:', 'ABC123: ABC123', 'ABC123 ABC123:', 'ABC1234:', '  ABC123  ',
+    '12ABC1234 X', '12ABCD123', '12ABC123', 'ABC1234', '1AB123', '1ABC123', 'AB1234', '1ABCD12', '1ABCD',
+    'ABCD12', '1ABCD1234', 'ABC123X', 'abc123', '', 'SERVICE FEE',
+])
+def test_single_lines(line):
+    assert_same_codes([line])
+
+
+def test_embedded_newlines():
+    assert_same_codes(['ABC123\nDEF456', 'PAYMENT\nDIV3', 'X\nABC123', 'DIV3\n3:', '12ABC1234\n', '\nABC123'])
+
+
+def test_missing_and_non_string_values():
+    assert_same_codes([np.nan, None, 1234, 12.5, 'ABC123', float('nan'), True])
+
+
+# Every description of the sample statements, without the first 6 characters the same as
+# the converter
+@pytest.mark.parametrize('statement', ['STANDARD STATEMENT RWC.TXT', 'STATEMENT.TXT', 'RWC STD 13DEC2024.txt'])
+def test_sample_statements(statement):
+    df = read_standard_bank_file(os.path.join(REPO, "temp", statement))
+    assert_same_codes(list(df[5].str.strip().str[6:]))
@@ -0,0 +1,66 @@
+import os
+
+import pandas as pd
+import pytest
+
+import cli
+from BANKS import build_master_index, read_master_file
+import utils
+from utils import write_chunks, write_excel_chunks
+
+TEMP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "temp")
+STATEMENT = os.path.join(TEMP, "STATEMENT.TXT")
+
+
+def failing_chunks():
+    yield pd.DataFrame({'A': [1, 2]})
+    raise ValueError("bad chunk")
+
+
+def test_writers_are_closed_when_a_chunk_fails():
+    closed = []
+    writers = [(lambda chunk: None, lambda: closed.append('first')),
+               (lambda chunk: None, lambda: closed.append('second'))]
+
+    with pytest.raises(ValueError, match="bad chunk"):
+        write_chunks(failing_chunks(), writers)
+    assert closed == ['first', 'second']
+
+
+# The last line has a field more than the others, so the statement fails while its later
+# chunks are read, after the first ones were written
+def test_failed_statement_leaves_no_output_files(tmp_path):
+    with open(STATEMENT) as f:
+        lines = f.read().splitlines()
+    path = tmp_path / "statement.txt"
+    path.write_text('\n'.join(lines + [lines[-1] + ',000.00']) + '\n')
+    output_paths = {'xlsx': str(tmp_path / "statement.xlsx"), 'csv': str(tmp_path / "statement.csv"),
+                    'parquet': str(tmp_path / "statement.parquet")}
+
+    cli.init_worker(pd.Series(dtype=object))
+    result = cli.convert_and_save('standard', str(path), output_paths, chunksize=10)
+
+    assert result['status'] == 'failed'
+    assert not any(os.path.exists(output_path) for output_path in output_paths.values())
+
+
+# A statement that doesn't fit in an Excel sheet fails, rather than being cut off
+def test_rows_past_the_excel_limit_fail(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'EXCEL_MAX_ROWS', 5)
+    chunk = pd.DataFrame({'A': [1, 2]})
+
+    assert write_excel_chunks([chunk, chunk], str(tmp_path / "fits.xlsx")) == 4
+    with pytest.raises(ValueError, match="rows that fit in an Excel sheet"):
+        write_excel_chunks([chunk, chunk, chunk], str(tmp_path / "too_long.xlsx"))
+
+
+def test_statement_past_the_excel_limit_leaves_no_output_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'EXCEL_MAX_ROWS', 15)
+    output_paths = {'xlsx': str(tmp_path / "statement.xlsx"), 'csv': str(tmp_path / "statement.csv")}
+
+    cli.init_worker(build_master_index(read_master_file(os.path.join(TEMP, "MASTERLIST.xlsx"))))
+    result = cli.convert_and_save('standard', STATEMENT, output_paths, chunksize=10)
+
+    assert result['status'] == 'failed'
+    assert "rows that fit in an Excel sheet" in result['error']
+    assert not any(os.path.exists(output_path) for output_path in output_paths.values())
@@ -0,0 +1,38 @@
+import os
+import time
+
+import BANKS
+
+CAPITEC_STATEMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "temp",
+                                 "CAPITEC STATEMENT.csv")
+
+
+class Upload:
+    def __init__(self, path, file_id):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.name = os.path.basename(path)
+        self.file_id = file_id
+
+    def getbuffer(self):
+        return memoryview(self.data)
+
+
+# Uploaded statements are only on disk while their job runs
+def test_uploads_are_deleted_once_the_job_is_finished(tmp_path, monkeypatch):
+    monkeypatch.setattr(BANKS, 'UPLOAD_DIR', str(tmp_path))
+    uploads = [Upload(CAPITEC_STATEMENT, "first"), Upload(CAPITEC_STATEMENT, "second")]
+
+    job = BANKS.start_upload_job("capitec", BANKS.convert_bank_files, uploads, 'capitec', output_mode='zip')
+    job['future'].result(timeout=60)
+
+    assert job['status'] == 'done'
+    assert not any(kind == 'error' for kind, _ in job['result']['messages'])
+    assert job['result']['downloads']
+
+    # The folder is deleted right after the job, by a callback of its future
+    for _ in range(100):
+        if not os.listdir(tmp_path):
+            break
+        time.sleep(0.05)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+from utils import OUTPUT_DATE_FORMAT, date_strings, parse_dates
+
+# Every bank converter builds the same compact frame of transactions, and the layout of
+# the converted file is only made when it is written:
+#   DATE        the transaction date, NaT where the statement date couldn't be read
+#   DATE_TEXT   the statement date as it was, only where it couldn't be read
+#   DESCRIPTION the description written to the converted file
+#   CODE        the code written to the converted file
+#   AMOUNT      integer cents, credits positive and debits negative
+# Text columns are categorical, so a description that appears on many rows is kept once.
+# Bank specific text columns, like the Capitec site, are categorical too.
+
+# Output column names of the description and code columns, and the bank specific columns
+# written between the code and the amounts
+BANK_LAYOUTS = {
+    'standard': {'DESCRIPTION': 'DESCRIPTION_CODE', 'CODE': 'CODE1', 'extra': []},
+    'absa': {'DESCRIPTION': 'DESCRIPTION', 'CODE': 'CODE', 'extra': []},
+    'capitec': {'DESCRIPTION': 'REFERENCE', 'CODE': None, 'extra': ['SITE', 'ACTIVITY']},
+}
+
+
+# DATE and DATE_TEXT columns from the dates in the statement
+def transaction_dates(dates, date_format):
+    parsed = parse_dates(dates, date_format)
+
+    # Dates already in the output format are kept as text when they don't read back the
+    # same, like a day without its leading zero
+    unread = parsed.isna()
+    if date_format == OUTPUT_DATE_FORMAT:
+        unread |= date_strings(parsed) != dates
+    return parsed, categorical(dates.astype(object).where(unread))
+
+
+# Amounts in integer cents, amounts that are missing count as zero
+def to_cents(amounts):
+    return np.round(np.nan_to_num(np.asarray(amounts, dtype=float)) * 100).astype(np.int64)
+
+
+# Categorical column that gives back the values exactly as they were, the categories are
+# never converted to another type
+def categorical(values):
+    codes, categories = pd.factorize(np.asarray(values, dtype=object))
+    return pd.Categorical.from_codes(codes, pd.Index(categories, dtype=object))
+
+
+# The compact frame of transactions of a bank. code is None for banks without codes,
+# extra holds the bank specific columns.
+def transaction_frame(bank_type, dates, date_format, description, code, amounts, extra=None):
+    dates = pd.Series(dates).reset_index(drop=True)
+    date, date_text = transaction_dates(dates, date_format)
+    columns = {
+        'DATE': date,
+        'DATE_TEXT': date_text,
+        'DESCRIPTION': categorical(description),
+        'CODE': categorical(code if code is not None else [None] * len(dates)),
+        'AMOUNT': to_cents(amounts),
+    }
+    for name, values in (extra or {}).items():
+        columns[name] = categorical(values)
+    df = pd.DataFrame(columns)
+    df.attrs['bank_type'] = bank_type
+    return df
+
+
+# Object column of the values with one more value added at the end, filled in one copy
+def with_last_value(values, last_value):
+    column = np.empty(len(values) + 1, dtype=object)
+    column[:-1] = values
+    column[-1] = last_value
+    return column
+
+
+# Text of a categorical column, missing values as NaN
+def text_values(column):
+    return column.astype(object).to_numpy()
+
+
+# The converted file, made from the compact frame in the layout of its bank. A summary
+# row, like the Capitec fee line, is kept in attrs['summary_row'] and added at the end.
+def format_transactions(df):
+    layout = BANK_LAYOUTS[df.attrs['bank_type']]
+
+    date = date_strings(df['DATE'])
+    date_text = df['DATE_TEXT'].notna().to_numpy()
+    date[date_text] = text_values(df['DATE_TEXT'])[date_text]
+
+    amount = df['AMOUNT'].to_numpy() / 100
+    columns = {'DATE': date, layout['DESCRIPTION']: text_values(df['DESCRIPTION'])}
+    if layout['CODE']:
+        columns[layout['CODE']] = text_values(df['CODE'])
+    for name in layout['extra']:
+        columns[name] = text_values(df[name])
+    columns['DEBIT'] = np.where(amount < 0, -amount, 0)
+    columns['CREDIT'] = np.where(amount > 0, amount, 0)
+
+    summary_row = df.attrs.get('summary_row')
+    if summary_row is not None:
+        columns = {name: with_last_value(values, summary_row[name]) for name, values in columns.items()}
+    return pd.DataFrame(columns)
+
+
+# Memory of a frame in MB, including the text it holds
+def frame_memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 2 ** 20
@@ -0,0 +1,820 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# xlsxwriter and pyarrow are only imported by the writers that use them, so pages that
+# never write those formats don't load them on startup
+
+# Format of every date written to the converted files
+OUTPUT_DATE_FORMAT = '%d/%m/%Y'
+
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_MIME = "application/zip"
+
+# Rows in an Excel sheet, the header included
+EXCEL_MAX_ROWS = 2 ** 20
+
+# File extension and MIME type of every output format
+OUTPUT_FORMATS = {
+    'xlsx': ('.xlsx', EXCEL_MIME),
+    'csv': ('.csv', "text/csv"),
+    'parquet': ('.parquet', "application/vnd.apache.parquet"),
+}
+
+# Rows sent to the browser per page of a preview
+PREVIEW_PAGE_ROWS = 100
+
+# Worker threads used to convert uploaded files concurrently
+CONVERT_WORKERS = os.cpu_count() or 1
+
+# Conversions started from the pages run as jobs in a pool of worker threads shared by
+# every session, so a rerun of the page doesn't throw the work away and one user's
+# conversion doesn't hold up another's
+JOB_WORKERS = os.cpu_count() or 1
+
+# Seconds between progress updates of running jobs, and finished jobs kept per page
+JOB_POLL_SECONDS = 1
+JOB_HISTORY = 10
+
+# Memory the cached conversion results may take up, the least recently used results
+# are dropped first once they take up more
+RESULT_CACHE_MAX_BYTES = 256 * 2 ** 20
+
+# Stage timings are logged here, one record per stage with the numbers as extra fields
+PERF_LOGGER = logging.getLogger("converter.performance")
+
+# Statement lines are written here when auditing is on, a folder per run with a folder per
+# statement with the lines that got a code and the lines that didn't
+AUDIT_DIR = os.path.join("temp", "audit")
+AUDIT_MATCHED_FILE = "processed_lines.csv"
+AUDIT_UNMATCHED_FILE = "unprocessed_lines.csv"
+
+# Stage records of the running conversion, None while instrumentation is off, and the
+# statement the stages belong to
+_stage_records = contextvars.ContextVar('stage_records', default=None)
+_stage_source = contextvars.ContextVar('stage_source', default='')
+
+# Audit of the running conversion, None while auditing is off
+_audit = contextvars.ContextVar('audit', default=None)
+
+# Job the running conversion belongs to, None outside of jobs
+_job = contextvars.ContextVar('job', default=None)
+_job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+# Whether the stages of the running conversion measure their memory
+_stage_memory = contextvars.ContextVar('stage_memory', default=False)
+
+# Memory is traced while any block measures the memory of its stages. Jobs do so at the
+# same time, so tracing is only stopped when the last of them is done.
+_tracing = {'blocks': 0, 'started': False}
+_tracing_lock = threading.Lock()
+
+# Cached conversion results, key -> (result, size in bytes), least recently used first.
+# Statements are converted in worker threads, so the cache is only used under the lock.
+_result_cache = collections.OrderedDict()
+_result_cache_bytes = 0
+_result_cache_lock = threading.Lock()
+
+
+# Single date parsed with the format, NaT when it can't be
+def parse_date(date, date_format='%Y%m%d'):
+    try:
+        return pd.to_datetime(date, format=date_format)
+    except Exception:
+        return pd.NaT
+
+
+# The date stage every converter uses. Parses the column in one go, only the rows that
+# fail are retried one by one. Dates that can't be read are NaT.
+def parse_dates(dates, date_format='%Y%m%d'):
+    parsed = pd.to_datetime(dates, format=date_format, errors='coerce')
+    failed = parsed.isna()
+    if failed.any():
+        parsed[failed] = dates[failed].map(lambda date: parse_date(date, date_format))
+    return parsed
+
+
+# Dates as text in the output format, NaN for NaT. A column only has a few hundred
+# different dates, so each is formatted once.
+def date_strings(dates):
+    codes, uniques = pd.factorize(dates)
+    text = np.append(np.asarray(uniques.strftime(OUTPUT_DATE_FORMAT), dtype=object), np.nan)
+    return text[codes]
+
+
+# Dates of a column in the output format. Unparseable values are passed through, or
+# raise the parser's error with errors='raise'.
+def format_dates(dates, date_format='%Y%m%d', errors='ignore'):
+    if errors == 'raise':
+        return pd.Series(date_strings(pd.to_datetime(dates, format=date_format)), index=dates.index, dtype=object)
+
+    parsed = parse_dates(dates, date_format)
+    unread = parsed.isna() & dates.notna()
+    formatted = pd.Series(date_strings(parsed), index=dates.index, dtype=object)
+    formatted[unread] = dates[unread]
+    return formatted
+
+
+# Chunk writers write frames one after the other into one file. Each is a pair of
+# functions, one to write the next chunk and one to finish the file.
+
+# Excel writer, the workbook is in constant memory mode so only the current row is kept
+# in memory
+def excel_chunk_writer(output, sheet_name='Sheet1'):
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    row = 0
+
+    def write(chunk):
+        nonlocal row
+        if row == 0:
+            worksheet.write_row(0, 0, chunk.columns, header_format)
+            row = 1
+
+        # xlsxwriter drops rows past the last row of a sheet without raising, a statement that
+        # doesn't fit fails the same as DataFrame.to_excel
+        if row + len(chunk) > EXCEL_MAX_ROWS:
+            raise ValueError(f"The statement has more than the {EXCEL_MAX_ROWS - 1:,} rows that fit in an "
+                             f"Excel sheet, convert it to csv or parquet instead")
+
+        # Empty cells are left blank, the same as DataFrame.to_excel
+        for values in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False):
+            if worksheet.write_row(row, 0, values) == -1:
+                raise ValueError(f"Row {row + 1:,} could not be written to the Excel sheet")
+            row += 1
+
+    return write, workbook.close
+
+
+def csv_chunk_writer(output):
+    f = open(output, 'wb') if isinstance(output, str) else output
+    header = True
+
+    def write(chunk):
+        nonlocal header
+        f.write(to_csv_bytes(chunk, header=header))
+        header = False
+
+    def close():
+        if f is not output:
+            f.close()
+
+    return write, close
+
+
+# Parquet writer. Every chunk must have the same schema, so object columns are always
+# written as text, even when a chunk has no values in them.
+def parquet_chunk_writer(output):
+    import pyarrow.parquet as pq
+
+    writer = None
+
+    def write(chunk):
+        nonlocal writer
+        table = parquet_table(chunk, chunk.columns[chunk.dtypes == object])
+        if writer is None:
+            writer = pq.ParquetWriter(output, table.schema)
+        writer.write_table(table)
+
+    def close():
+        if writer is not None:
+            writer.close()
+
+    return write, close
+
+
+CHUNK_WRITERS = {
+    'xlsx': excel_chunk_writer,
+    'csv': csv_chunk_writer,
+    'parquet': parquet_chunk_writer,
+}
+
+
+# Write every chunk to all the writers, so a statement is converted once for all formats.
+# Returns the number of rows written. The writers are closed even when a chunk fails, the
+# error of the chunk is the one raised.
+def write_chunks(chunks, writers):
+    rows = 0
+    try:
+        for chunk in chunks:
+            for write, _ in writers:
+                write(chunk)
+            rows += len(chunk)
+    except BaseException:
+        for _, close in writers:
+            with contextlib.suppress(Exception):
+                close()
+        raise
+
+    for _, close in writers:
+        close()
+    return rows
+
+
+# Writers for a dict of output format -> file name or file object
+def open_chunk_writers(outputs):
+    return [CHUNK_WRITERS[output_format](output) for output_format, output in outputs.items()]
+
+
+# Write frames one after the other into a single sheet, one row at a time. Returns the
+# number of rows written.
+def write_excel_chunks(chunks, output, sheet_name='Sheet1'):
+    return write_chunks(chunks, [excel_chunk_writer(output, sheet_name)])
+
+
+# Build the Excel file in memory, ready for st.download_button
+def to_excel_bytes(df):
+    output = io.BytesIO()
+    df.to_excel(output, index=False)
+    return output.getvalue()
+
+
+def to_csv_bytes(df, header=True):
+    return df.to_csv(index=False, header=header).encode('utf-8')
+
+
+# Arrow table of a frame with the given columns as text, empty values stay empty
+def parquet_table(df, text_columns):
+    import pyarrow as pa
+
+    df = df.assign(**{column: df[column].map(lambda value: value if pd.isna(value) else str(value))
+                      for column in text_columns})
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for column in text_columns:
+        schema = schema.set(schema.get_field_index(column), pa.field(column, pa.string()))
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+# Parquet columns have a single type. Object columns holding only numbers are written as
+# numbers, all other object columns as text.
+def to_parquet_bytes(df):
+    text_columns = []
+    for column in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[column], skipna=True) in ('integer', 'floating', 'mixed-integer-float'):
+            df = df.assign(**{column: pd.to_numeric(df[column])})
+        else:
+            text_columns.append(column)
+
+    import pyarrow.parquet as pq
+
+    output = io.BytesIO()
+    pq.write_table(parquet_table(df, text_columns), output)
+    return output.getvalue()
+
+
+# Build the file for one frame in any of the output formats
+def to_format_bytes(df, output_format):
+    if output_format == 'csv':
+        return to_csv_bytes(df)
+    if output_format == 'parquet':
+        return to_parquet_bytes(df)
+    return to_excel_bytes(df)
+
+
+# Several named frames in one download: a workbook with a sheet each for Excel, a ZIP
+# file with a file each for the other formats. Returns the data, file name and MIME type.
+def to_format_sheets(sheets, output_format, stem):
+    if output_format == 'xlsx':
+        return to_excel_sheets_bytes(sheets), f"{stem}.xlsx", EXCEL_MIME
+
+    extension = OUTPUT_FORMATS[output_format][0]
+    files = {f"{sheet_name}{extension}": to_format_bytes(df, output_format) for sheet_name, df in sheets.items()}
+    return to_zip_bytes(files), f"{stem} {output_format}.zip", ZIP_MIME
+
+
+# Output format picker shared by every page, Excel when nothing is picked
+def select_output_formats():
+    output_formats = st.multiselect("Output formats", list(OUTPUT_FORMATS), default=['xlsx'],
+                                    help="CSV and Parquet are much faster to write than Excel for large files")
+    return output_formats or ['xlsx']
+
+
+# Preview of frames that together make up one table, a page of rows at a time, so large
+# results are never sent to the browser in full. Turning the page only reruns the preview.
+@st.fragment
+def show_paged_preview(frames, key, page_rows=PREVIEW_PAGE_ROWS):
+    total_rows = sum(len(df) for df in frames)
+    pages = max(1, -(-total_rows // page_rows))
+    page = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1, key=key)
+    start = (page - 1) * page_rows
+    stop = min(start + page_rows, total_rows)
+
+    # Only the rows of this page are taken from the frames they are in
+    rows = []
+    offset = 0
+    for df in frames:
+        if offset < stop and offset + len(df) > start:
+            rows.append(df.iloc[max(start - offset, 0):stop - offset])
+        offset += len(df)
+    preview = pd.concat(rows) if rows else frames[0].iloc[:0]
+    preview.index = pd.RangeIndex(start, start + len(preview))
+
+    st.dataframe(preview)
+    st.caption(f"Rows {min(start + 1, total_rows):,} to {stop:,} of {total_rows:,}")
+
+
+# Build a workbook with one sheet per frame in memory, sheets is a dict of sheet name -> frame
+def to_excel_sheets_bytes(sheets):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return output.getvalue()
+
+
+# Excel sheet names are at most 31 characters, can't contain []:*?/\ and must be unique
+def excel_sheet_names(names):
+    sheet_names = []
+    for name in names:
+        base = re.sub(r'[\[\]:*?/\\]', '_', name)[:31] or 'Sheet'
+        sheet_name = base
+        number = 1
+        while sheet_name.lower() in (used.lower() for used in sheet_names):
+            number += 1
+            suffix = f" ({number})"
+            sheet_name = base[:31 - len(suffix)] + suffix
+        sheet_names.append(sheet_name)
+    return sheet_names
+
+
+# Bundle several files into one ZIP file in memory, files is a dict of file name -> bytes
+def to_zip_bytes(files):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for file_name, data in files.items():
+            archive.writestr(file_name, data)
+    return output.getvalue()
+
+
+# Keep a copy of a converted file in the temp folder
+def save_output_copy(data, file_name):
+    os.makedirs("temp", exist_ok=True)
+    with open(os.path.join("temp", file_name), "wb") as f:
+        f.write(data)
+
+
+# A file built for download, kept until the page offers it
+def download(data, file_name, label, mime):
+    return {'data': data, 'file_name': file_name, 'label': label, 'mime': mime}
+
+
+# Download buttons for built files, the key keeps the buttons of different jobs apart
+def offer_downloads(downloads, key=''):
+    for file in downloads:
+        st.download_button(label=file['label'], data=file['data'], file_name=file['file_name'], mime=file['mime'],
+                           key=f"download {key} {file['file_name']}")
+
+
+# Messages of a conversion that ran without showing anything, (kind, text) pairs where
+# kind is the Streamlit function that shows it, like 'error' or 'write'
+def show_messages(messages):
+    for kind, text in messages:
+        getattr(st, kind)(text)
+
+
+# Convert files in a pool of worker threads, results come back in the order of
+# file_list. Streamlit calls must stay on the script thread, so the workers only
+# return results and the caller shows errors and downloads.
+def convert_concurrently(convert, file_list):
+    results = [None] * len(file_list)
+    for position, result in convert_as_completed(convert, file_list):
+        results[position] = result
+    return results
+
+
+# Convert files in a pool of worker threads, every result is handed back as soon as its
+# file is converted, with the position of the file in file_list
+def convert_as_completed(convert, file_list):
+    # Every worker runs in a copy of the caller's context, so stage records are kept
+    def convert_in_context(context, file):
+        return context.run(convert_file, convert, file)
+
+    job_progress(total=len(file_list))
+    with ThreadPoolExecutor(max_workers=max(1, min(CONVERT_WORKERS, len(file_list)))) as pool:
+        futures = {pool.submit(convert_in_context, contextvars.copy_context(), file): position
+                   for position, file in enumerate(file_list)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# Stages of the conversion belong to the file, uploaded files go by their name
+def convert_file(convert, file):
+    with stage_source(getattr(file, 'name', file)):
+        result = convert(file)
+    job_progress(done=1)
+    return result
+
+
+# Hash of a source file, computed once per version of the file
+@functools.lru_cache(maxsize=None)
+def _source_digest(path, modified):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+# Version of the code in the given source files, changes whenever one of them changes.
+# Scripts are run again on every rerun, this only reads files that changed since.
+def source_version(*paths):
+    return hashlib.sha256(b''.join(_source_digest(path, os.stat(path).st_mtime_ns) for path in paths)).hexdigest()
+
+
+# Cache key for a conversion result, a hash of everything the result depends on. Every
+# part is length prefixed, so different parts never run together into the same key.
+def result_cache_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode()
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+# The cached result for the key, or None when it isn't cached
+def get_cached_result(key):
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None:
+            return None
+        _result_cache.move_to_end(key)
+        return entry[0]
+
+
+# Cache a converted frame or finished file. Results larger than the whole cache are
+# not kept.
+def cache_result(key, result):
+    global _result_cache_bytes
+    if isinstance(result, pd.DataFrame):
+        size = int(result.memory_usage(index=True, deep=True).sum())
+    else:
+        size = len(result)
+
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache_bytes -= _result_cache.pop(key)[1]
+        if size > RESULT_CACHE_MAX_BYTES:
+            return
+        _result_cache[key] = (result, size)
+        _result_cache_bytes += size
+        while _result_cache_bytes > RESULT_CACHE_MAX_BYTES:
+            _, (_, dropped_size) = _result_cache.popitem(last=False)
+            _result_cache_bytes -= dropped_size
+
+
+# Number of cached results and the memory they take up
+def result_cache_size():
+    with _result_cache_lock:
+        return len(_result_cache), _result_cache_bytes
+
+
+def clear_result_cache():
+    global _result_cache_bytes
+    with _result_cache_lock:
+        _result_cache.clear()
+        _result_cache_bytes = 0
+
+
+# Raised in a job that was cancelled. It isn't an Exception, so converters that turn every
+# error into a message let it through.
+class JobCancelled(BaseException):
+    pass
+
+
+# Run a conversion in the background. The job is a dict with its progress, and once it is
+# finished its result or error. It runs in a copy of the caller's context, so an audit
+# started around the call covers it. run must not call Streamlit, the page shows the
+# result once the job is finished.
+def submit_job(name, run, *args, **kwargs):
+    job = {'id': uuid.uuid4().hex, 'name': name, 'status': 'queued', 'stage': "waiting for a worker",
+           'done': 0, 'total': 0, 'lock': threading.Lock(), 'cancel': threading.Event(),
+           'result': None, 'error': None, 'seconds': None}
+    job['future'] = _job_pool.submit(contextvars.copy_context().run, run_job, job, run, *args, **kwargs)
+    return job
+
+
+def run_job(job, run, *args, **kwargs):
+    _job.set(job)
+    job['status'] = 'running'
+    status = 'failed'
+    start = time.perf_counter()
+    try:
+        if job['cancel'].is_set():
+            raise JobCancelled()
+        job['result'] = run(*args, **kwargs)
+        status = 'done'
+    except JobCancelled:
+        status = 'cancelled'
+    except Exception as e:
+        logging.exception("Job %s failed", job['name'])
+        job['error'] = str(e)
+    finally:
+        # The page reads the status last, everything else is set by then
+        job['seconds'] = time.perf_counter() - start
+        job['status'] = status
+
+
+# A job waiting for a worker never starts, a running one stops at its next stage
+def cancel_job(job):
+    job['cancel'].set()
+    if job['future'].cancel():
+        job['status'] = 'cancelled'
+
+
+def job_finished(job):
+    return job['status'] not in ('queued', 'running')
+
+
+# Add to the work of the running job, counted in statements or files. The total grows as
+# work is found, so the bar can go back a little when a later step adds more.
+def job_progress(done=0, total=0):
+    job = _job.get()
+    if job is None:
+        return
+    with job['lock']:
+        job['done'] += done
+        job['total'] += total
+
+
+# Jobs started from a page in this session, oldest first. They are kept in the session
+# state, so they carry on and keep their results through reruns.
+def session_jobs(page):
+    return st.session_state.setdefault(f"{page} jobs", [])
+
+
+# Start a job from a page. Only the last JOB_HISTORY finished jobs of the page are kept.
+def start_job(page, name, run, *args, **kwargs):
+    jobs = session_jobs(page)
+    finished = [job for job in jobs if job_finished(job)]
+    for job in finished[:max(len(finished) - JOB_HISTORY + 1, 0)]:
+        jobs.remove(job)
+    job = submit_job(name, run, *args, **kwargs)
+    jobs.append(job)
+    return job
+
+
+# Copy of an uploaded file for a job to read. The page's uploaded files are the same objects
+# on every rerun, so two jobs reading one would move each other's read position.
+def job_file(uploaded_file):
+    if uploaded_file is None:
+        return None
+    copy = io.BytesIO(uploaded_file.getvalue())
+    copy.name = uploaded_file.name
+    return copy
+
+
+# Progress bars of the page's jobs, and the result of every finished one, shown by
+# show_result(result, key). While jobs run only this panel is updated, every
+# JOB_POLL_SECONDS, the rest of the page isn't run again.
+def show_jobs(page, show_result):
+    jobs = session_jobs(page)
+    running = not all(job_finished(job) for job in jobs)
+
+    @st.fragment(run_every=JOB_POLL_SECONDS if running else None)
+    def job_panel():
+        for job in jobs:
+            show_job(job, show_result)
+
+        # Once every job is finished the whole page is run again, which stops the updates
+        if running and all(job_finished(job) for job in jobs):
+            st.rerun()
+
+        if any(job_finished(job) for job in jobs) and st.button("Clear finished jobs", key=f"{page} clear jobs"):
+            jobs[:] = [job for job in jobs if not job_finished(job)]
+            st.rerun()
+
+    if jobs:
+        job_panel()
+
+
+def show_job(job, show_result):
+    with st.container(border=True):
+        if job['status'] in ('queued', 'running'):
+            with job['lock']:
+                fraction = min(job['done'] / job['total'], 1.0) if job['total'] else 0.0
+            st.progress(fraction, text=f"{job['name']}: {job['stage']}")
+            if job['cancel'].is_set():
+                st.caption("Cancelling...")
+            elif st.button("Cancel", key=f"cancel {job['id']}"):
+                cancel_job(job)
+                st.caption("Cancelling...")
+        elif job['status'] == 'done':
+            st.write(f"{job['name']}: finished in {job['seconds']:.1f}s")
+            show_result(job['result'], job['id'])
+        elif job['status'] == 'cancelled':
+            st.warning(f"{job['name']}: cancelled.")
+        else:
+            st.error(f"{job['name']}: failed: {job['error']}")
+
+
+# Show a job that converted files once it is done: its messages, downloads and performance
+# details. key keeps apart the downloads of different jobs.
+def show_conversion(result, key=''):
+    show_messages(result['messages'])
+    offer_downloads(result['downloads'], key)
+    show_stage_records(result['records'], result['show_details'])
+
+
+# Collect stage records for everything run inside the block. When disabled the stages
+# only cost a context variable lookup. With trace_memory the peak memory of every stage
+# is measured too, memory is then traced for the whole process and every allocation costs
+# more, so it is only done when the details are shown.
+@contextlib.contextmanager
+def record_stages(enabled=True, trace_memory=False):
+    if not enabled:
+        yield None
+        return
+
+    records = []
+    token = _stage_records.set(records)
+    memory_token = _stage_memory.set(trace_memory)
+    if trace_memory:
+        with _tracing_lock:
+            if _tracing['blocks'] == 0:
+                _tracing['started'] = not tracemalloc.is_tracing()
+                if _tracing['started']:
+                    tracemalloc.start()
+            _tracing['blocks'] += 1
+    try:
+        yield records
+    finally:
+        _stage_records.reset(token)
+        _stage_memory.reset(memory_token)
+        if trace_memory:
+            with _tracing_lock:
+                _tracing['blocks'] -= 1
+                if _tracing['blocks'] == 0 and _tracing['started']:
+                    tracemalloc.stop()
+
+
+# Stages in the block belong to this statement
+@contextlib.contextmanager
+def stage_source(source):
+    token = _stage_source.set(os.path.basename(str(source)))
+    try:
+        yield
+    finally:
+        _stage_source.reset(token)
+
+
+# Time one stage of a conversion. Set record['rows'] to the number of rows handled.
+# Peak memory, when it is measured, is what the stage allocated on top of what was
+# already in use. tracemalloc keeps one peak for the whole process, so stages running at
+# the same time in other threads and jobs add to it, and each resets the peak of the
+# others when it starts. In a job every stage shows up in its progress, and a cancelled
+# job stops when its next stage starts.
+@contextlib.contextmanager
+def stage(name):
+    job = _job.get()
+    if job is not None:
+        if job['cancel'].is_set():
+            raise JobCancelled()
+        job['stage'] = ': '.join(filter(None, (_stage_source.get(), name)))
+
+    record = {'rows': None}
+    records = _stage_records.get()
+    if records is None:
+        yield record
+        return
+
+    trace_memory = _stage_memory.get()
+    if trace_memory:
+        memory_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.update(source=_stage_source.get(), stage=name, seconds=time.perf_counter() - start, peak_mb=None)
+        if trace_memory:
+            record['peak_mb'] = max(tracemalloc.get_traced_memory()[1] - memory_before, 0) / 2 ** 20
+        records.append(record)
+        if trace_memory:
+            PERF_LOGGER.info("%s: %s took %.3fs for %s rows, %.1f MB peak", record['source'], name,
+                             record['seconds'], record['rows'], record['peak_mb'], extra={'performance': record})
+        else:
+            PERF_LOGGER.info("%s: %s took %.3fs for %s rows", record['source'], name, record['seconds'],
+                             record['rows'], extra={'performance': record})
+
+
+# Every run of audits writes to its own folder in the directory, named by the time it started
+def audit_run_folder(directory=AUDIT_DIR):
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+
+
+# Write the matched and unmatched lines of every statement converted inside the block to
+# a folder per statement in the run folder, a new run folder in AUDIT_DIR when none is
+# given. The audit files are added to chunk by chunk.
+@contextlib.contextmanager
+def audit_lines(run_folder=None, enabled=True):
+    if not enabled:
+        yield
+        return
+
+    token = _audit.set({'run folder': run_folder or audit_run_folder(), 'folders': {},
+                        'lock': threading.Lock()})
+    try:
+        yield
+    finally:
+        _audit.reset(token)
+
+
+def auditing():
+    return _audit.get() is not None
+
+
+# Folder for the audit files of one statement. Statements with the same name, from other
+# directories or other processes of the same run, are numbered instead of overwritten.
+def new_audit_folder(run_folder, name):
+    folder = os.path.join(run_folder, name)
+    number = 1
+    while True:
+        try:
+            os.makedirs(folder)
+            return folder
+        except FileExistsError:
+            number += 1
+            folder = os.path.join(run_folder, f"{name} ({number})")
+
+
+# Add statement lines to the audit files of the current statement. Lines with a code
+# are written with the code and the pattern that found it.
+def write_audit_lines(lines, codes, patterns):
+    audit = _audit.get()
+    if audit is None:
+        return
+
+    source = _stage_source.get() or "statement"
+    with audit['lock']:
+        if source not in audit['folders']:
+            audit['folders'][source] = new_audit_folder(audit['run folder'], source)
+        folder = audit['folders'][source]
+
+    matched = codes.notna()
+    for file_name, rows in ((AUDIT_MATCHED_FILE, lines[matched].assign(CODE=codes[matched],
+                                                                       PATTERN=patterns[matched])),
+                            (AUDIT_UNMATCHED_FILE, lines[~matched])):
+        path = os.path.join(folder, file_name)
+        rows.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
+
+# Counts kept in stage records, the key in the record -> title and column name of the
+# table in the performance details
+STAGE_COUNTS = {
+    'record_types': ("Record types:", 'record type'),
+    'patterns': ("Code pattern hits:", 'pattern'),
+}
+
+
+# Stages are timed when the page asks for it or performance records are logged. Their
+# memory is only measured when the page shows the details.
+def stages_enabled(show_details):
+    return show_details or PERF_LOGGER.isEnabledFor(logging.INFO)
+
+
+# Performance details expander, stages that ran more than once (chunks) are added up
+def show_stage_records(records, show_details=True):
+    if not records or not show_details:
+        return
+
+    df = pd.DataFrame(records)
+    df['rows'] = pd.to_numeric(df['rows'])
+    summary = df.groupby(['source', 'stage'], sort=False).agg(
+        runs=('stage', 'size'), seconds=('seconds', 'sum'), rows=('rows', lambda rows: rows.sum(min_count=1)), peak_mb=('peak_mb', 'max'))
+    summary['rows_per_sec'] = (summary['rows'] / summary['seconds']).round()
+
+    with st.expander("Performance details"):
+        st.dataframe(summary.reset_index().round({'seconds': 3, 'peak_mb': 1}), hide_index=True)
+
+        # Counts some stages keep, like the lines each code pattern found
+        for key, (title, name) in STAGE_COUNTS.items():
+            counts = [(record['source'], value, count) for record in records
+                      for value, count in record.get(key, {}).items()]
+            if counts:
+                st.write(title)
+                st.dataframe(count_table(counts, name), hide_index=True)
+
+
+# Counts of (source, value, count) added up per statement, with the share of each value
+def count_table(counts, name):
+    table = pd.DataFrame(counts, columns=['source', name, 'count'])
+    table = table.groupby(['source', name], sort=False)['count'].sum().reset_index()
+    table['share'] = (table['count'] / table.groupby('source')['count'].transform('sum')).round(3)
+    return table